@@ -1,9 +1,21 @@
 import streamlit as st
-import boto3
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import os
-import pypdf
-import docx
+import json
+import time
+from document_index import DocumentIndex
+from extraction import PDF_TYPE, DOCX_TYPE, TXT_TYPE
+from document_store import StoredDocument
+from governor import GOVERNORS
+from pipeline import PipelineListener, run_pipeline, PASSAGES_MODE, FULL_DOCUMENT_MODE
+from reference_data import STATES, GRADE_OPTIONS, SUBJECT_OPTIONS
+from sections import diff_sections, section_hashes
+from message_store import MessageStore, prune_history
+from batching import section_heading
+from jobs import DONE, FINISHED, JOB_POLL_SECONDS, QUEUED
+from resources import (get_analysis_cache, get_bedrock_client, get_document_store, get_job_queue, get_rag_client,
+                       get_retrieval_cache, get_standards_library, get_trace_exporter)
+from telemetry import Trace, CACHE_OUTCOME, INPUT_TOKENS, OUTPUT_TOKENS, CACHE_READ_TOKENS, CACHE_WRITE_TOKENS, BEDROCK_LATENCY_MS
 
 # Load environment variables from .env file
 #load_dotenv()
@@ -15,75 +27,207 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Sample data for dropdowns
-STATES = [
-    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", 
-    "Connecticut", "Delaware", "Florida", "Georgia", "Hawaii", "Idaho", 
-    "Illinois", "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", 
-    "Maine", "Maryland", "Massachusetts", "Michigan", "Minnesota", 
-    "Mississippi", "Missouri", "Montana", "Nebraska", "Nevada", 
-    "New Hampshire", "New Jersey", "New Mexico", "New York", 
-    "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon", 
-    "Pennsylvania", "Rhode Island", "South Carolina", "South Dakota", 
-    "Tennessee", "Texas", "Utah", "Vermont", "Virginia", "Washington", 
-    "West Virginia", "Wisconsin", "Wyoming"
-]
-
-GRADE_LEVELS = [
-    "Kindergarten", "1st Grade", "2nd Grade", "3rd Grade", 
-    "4th Grade", "5th Grade", "6th Grade", "7th Grade", "8th Grade", 
-    "9th Grade", "10th Grade", "11th Grade", "12th Grade"
-]
-
-SUBJECTS = [
-    "English", "Social Studies", "U.S. History", "World History"
-]
-
-def extract_text_from_pdf(file) -> str:
-    """Extract text from PDF file"""
+def get_library_documents(states: List[str], subject: str) -> Dict[str, Tuple[StoredDocument, DocumentIndex]]:
+    """Library documents and indexes for the selected states; nothing is extracted here"""
+    if not states:
+        return {}
     try:
-        pdf_reader = pypdf.PdfReader(file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        return get_standards_library().documents_for(states, subject)
     except Exception as e:
-        st.error(f"Error reading PDF: {str(e)}")
-        return ""
+        st.warning(f"⚠️ Standards library unavailable: {str(e)}")
+        return {}
+
+# Traces kept per session for the sidebar export
+MAX_SESSION_TRACES = 50
+
+def record_trace(trace: Trace, export: bool = True) -> None:
+    """Keep a finished trace for export and, unless it was already written, append it to the trace file"""
+    if "traces" not in st.session_state:
+        st.session_state.traces = []
+    st.session_state.traces = st.session_state.traces[-(MAX_SESSION_TRACES - 1):] + [trace]
+    exporter = get_trace_exporter()
+    if export and exporter is not None:
+        exporter.export(trace)
+
+def build_pipeline_log(run_stats: Dict[str, Any], trace: Trace, started_at: str, documents_count: int) -> Dict[str, Any]:
+    """Pipeline log of one interaction, built from the measured spans"""
+    pipeline_log = {
+        "timestamp": started_at,
+        "trace_id": trace.trace_id,
+        "duration": run_stats["timings"]["total"],
+        "usage": run_stats["usage"],
+        "stages": trace.summary(),
+        "cache": [],
+        "documents_count": documents_count
+    }
 
-def extract_text_from_docx(file) -> str:
-    """Extract text from DOCX file"""
-    try:
-        doc = docx.Document(file)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
-    except Exception as e:
-        st.error(f"Error reading DOCX: {str(e)}")
-        return ""
+    if "analysis_cache" in run_stats:
+        cache_stats = run_stats["analysis_cache"]
+        pipeline_log["cache"].append(
+            f"🗃️ PATH 1: ANALYSIS CACHE: {cache_stats['hits']} hits / {cache_stats['misses']} misses this turn ({cache_stats['total_hits']} hits / {cache_stats['total_misses']} misses since startup)"
+        )
 
-def extract_text_from_txt(file) -> str:
-    """Extract text from TXT file"""
+    if "retrieval_cache" in run_stats:
+        retrieval_stats = run_stats["retrieval_cache"]
+        pipeline_log["cache"].append(
+            f"🗃️ PATH 2: RETRIEVAL CACHE: {retrieval_stats['outcome']} ({retrieval_stats['hits']} hits / {retrieval_stats['coalesced']} coalesced / {retrieval_stats['misses']} misses since startup)"
+        )
+    return pipeline_log
+
+def show_pipeline_log(log: Dict[str, Any]) -> None:
+    """Measured stages of one pipeline run"""
+    usage = log["usage"]
+    st.caption(f"⏱️ {log['duration']:.2f}s total · {usage['model_calls']} model calls · {usage['input_tokens']} input / {usage['output_tokens']} output tokens")
+    if usage.get("cache_read_tokens") or usage.get("cache_write_tokens"):
+        st.caption(f"🧠 Prompt cache: {usage['cache_read_tokens']} tokens read / {usage['cache_write_tokens']} tokens written")
+    rows = []
+    for stage in log["stages"]:
+        attributes = stage["attributes"]
+        rows.append({
+            "Stage": stage["name"] + (f" ({attributes['document.name']})" if "document.name" in attributes else ""),
+            "ms": stage["duration_ms"],
+            "Input tokens": attributes.get(INPUT_TOKENS),
+            "Output tokens": attributes.get(OUTPUT_TOKENS),
+            "Cache read tokens": attributes.get(CACHE_READ_TOKENS),
+            "Cache write tokens": attributes.get(CACHE_WRITE_TOKENS),
+            "Bedrock ms": attributes.get(BEDROCK_LATENCY_MS),
+            "Cache": attributes.get(CACHE_OUTCOME),
+            "Status": f"❌ {stage['error']}" if stage["error"] else "✅"
+        })
+    st.dataframe(rows, hide_index=True)
+    for cache_line in log["cache"]:
+        st.info(cache_line)
+    if log["documents_count"] > 0:
+        st.info(f"📄 {log['documents_count']} uploaded documents processed")
+
+def process_uploaded_file(uploaded_file) -> Optional[StoredDocument]:
+    """Process uploaded file and extract text"""
+    file_type = uploaded_file.type
+    file_kind = {PDF_TYPE: "PDF", DOCX_TYPE: "DOCX", TXT_TYPE: "TXT"}.get(file_type)
+    
+    if file_kind is None:
+        st.error(f"Unsupported file type: {file_type}")
+        return None
+    
     try:
-        return str(file.read(), "utf-8")
+        # Text is streamed to disk page by page; identical files are only extracted once
+        store = get_document_store()
+        store.prune()
+        return store.ingest(uploaded_file, file_type)
     except Exception as e:
-        st.error(f"Error reading TXT: {str(e)}")
-        return ""
+        st.error(f"Error reading {file_kind}: {str(e)}")
+        return None
 
-def process_uploaded_file(uploaded_file) -> str:
-    """Process uploaded file and extract text"""
-    file_type = uploaded_file.type
+# Memory a session may spend on document indexes (document text itself stays on disk)
+SESSION_MEMORY_BUDGET_MB = float(os.getenv('SESSION_MEMORY_BUDGET_MB', '128'))
+
+def get_document_index(name: str, doc_info: Dict[str, Any]) -> DocumentIndex:
+    """Chunk index for an uploaded document, rebuilt only when its content changes"""
+    if "document_indexes" not in st.session_state:
+        st.session_state.document_indexes = {}
     
-    if file_type == "application/pdf":
-        return extract_text_from_pdf(uploaded_file)
-    elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        return extract_text_from_docx(uploaded_file)
-    elif file_type == "text/plain":
-        return extract_text_from_txt(uploaded_file)
+    entry = st.session_state.document_indexes.get(name)
+    if entry is None or entry["file_hash"] != doc_info["file_hash"]:
+        entry = {
+            "file_hash": doc_info["file_hash"],
+            "index": DocumentIndex(doc_info["document"])
+        }
+        st.session_state.document_indexes[name] = entry
+    return entry["index"]
+
+def session_memory_usage(exclude: str = None) -> int:
+    """Approximate bytes held by this session's document indexes"""
+    return sum(
+        entry["index"].memory_bytes
+        for name, entry in st.session_state.get("document_indexes", {}).items()
+        if name != exclude
+    )
+
+# Sidebar sections below are fragments: interacting with one reruns only that
+# section, and the chat reads the selections from session state when it runs
+
+@st.fragment
+def show_uploaded_documents() -> None:
+    """Previews of this session's documents, with remove buttons"""
+    if not st.session_state.get("uploaded_documents"):
+        return
+    st.header("📚 Uploaded Documents")
+    for doc_name, doc_info in list(st.session_state.uploaded_documents.items()):
+        try:
+            preview = doc_info["document"].preview(500)
+        except FileNotFoundError:
+            # The session sat idle past DOCUMENT_STORE_TTL_HOURS and the text was pruned
+            del st.session_state.uploaded_documents[doc_name]
+            st.session_state.get("document_indexes", {}).pop(doc_name, None)
+            st.warning(f"⚠️ {doc_name} expired after a long idle period; please upload it again")
+            continue
+        with st.expander(f"📄 {doc_name} v{doc_info.get('version', 1)} ({doc_info['size']} chars)"):
+            st.text_area("Content preview:", preview + "..." if doc_info["size"] > 500 else preview, height=100, disabled=True)
+            if st.button(f"🗑️ Remove {doc_name}", key=f"remove_{doc_name}"):
+                del st.session_state.uploaded_documents[doc_name]
+                st.session_state.get("document_indexes", {}).pop(doc_name, None)
+                st.rerun(scope="fragment")
+
+@st.fragment
+def context_filters() -> None:
+    """State, grade and subject filters, kept in session state"""
+    st.header("🔍 Context Filters")
+    st.multiselect("Select States", STATES, key="selected_states")
+    st.selectbox("Select Grade Level", GRADE_OPTIONS, key="selected_grade")
+    st.selectbox("Select Subject", SUBJECT_OPTIONS, key="selected_subject")
+    
+    # Standards for the selected states are attached from the library, already extracted and indexed
+    library_documents = get_library_documents(st.session_state.selected_states, st.session_state.selected_subject)
+    if library_documents:
+        st.caption("📚 From the standards library: " + ", ".join(library_documents))
+
+@st.fragment
+def show_pipeline_history(chat_history: MessageStore) -> None:
+    """The last three pipeline runs and the trace export"""
+    st.subheader("📊 Pipeline History")
+    recent_logs = chat_history.recent_logs(3)  # Show last 3
+    if recent_logs:
+        for i, (log, message) in enumerate(recent_logs):
+            with st.expander(f"Execution #{log['execution']} - {log['timestamp']} ({log['duration']:.1f}s)", expanded=(i==0)):
+                show_pipeline_log(log)
+                
+                # Show a preview of the response
+                response_preview = message["content"][:200] + "..." if len(message["content"]) > 200 else message["content"]
+                st.text_area("Response Preview", response_preview, height=100, disabled=True, key=f"response_preview_{log['trace_id']}")
     else:
-        st.error(f"Unsupported file type: {file_type}")
-        return ""
+        st.info("No pipeline executions yet")
+    
+    if st.session_state.get("traces"):
+        # Serialized only when the button is clicked, not on every rerun
+        traces = list(st.session_state.traces)
+        st.download_button(
+            "⬇️ Export traces (JSONL)",
+            lambda: "".join(json.dumps(trace.to_otlp()) + "\n" for trace in traces),
+            file_name="pipeline-traces.jsonl",
+            mime="application/jsonl",
+            on_click="ignore",
+            help="OpenTelemetry (OTLP/JSON) spans of this session's uploads and pipeline runs"
+        )
+
+# Chat messages rendered per page of history
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', '10'))
+
+if "chat_history" not in st.session_state:
+    prune_history()
+    st.session_state.chat_history = MessageStore()
+chat_history = st.session_state.chat_history
+
+# Questions run as background jobs whose ID is kept in the URL, so a reload or a
+# dropped connection picks the running analysis up again instead of losing it
+if "active_job" not in st.session_state:
+    st.session_state.active_job = None
+    resumed_job_id = st.query_params.get("job")
+    resumed_job = get_job_queue().get(resumed_job_id) if resumed_job_id else None
+    if resumed_job is not None:
+        chat_history.append("user", resumed_job["question"])
+        st.session_state.active_job = resumed_job_id
+    elif resumed_job_id:
+        st.query_params.pop("job", None)
 
 st.title("🤖 Standards Alignment Helper")
 st.write("Chat with an AI using AWS Bedrock!")
@@ -104,421 +248,279 @@ with st.sidebar:
         if "uploaded_documents" not in st.session_state:
             st.session_state.uploaded_documents = {}
         
+        if "document_indexes" not in st.session_state:
+            st.session_state.document_indexes = {}
+        
+        if "processed_uploads" not in st.session_state:
+            st.session_state.processed_uploads = set()
+        
         for uploaded_file in uploaded_files:
-            if uploaded_file.name not in st.session_state.uploaded_documents:
-                with st.spinner(f"Processing {uploaded_file.name}..."):
-                    text_content = process_uploaded_file(uploaded_file)
-                    if text_content:
-                        st.session_state.uploaded_documents[uploaded_file.name] = {
-                            "content": text_content,
-                            "size": len(text_content)
-                        }
-                        st.success(f"✅ {uploaded_file.name} processed successfully")
+            # Every upload is handled once; a re-uploaded file gets a new file_id
+            if uploaded_file.file_id in st.session_state.processed_uploads:
+                continue
+            st.session_state.processed_uploads.add(uploaded_file.file_id)
+            
+            with st.spinner(f"Processing {uploaded_file.name}..."):
+                trace = Trace("document.ingest", **{"document.name": uploaded_file.name, "document.bytes": uploaded_file.size})
+                with trace.span("extraction", **{"document.type": uploaded_file.type}) as span:
+                    document = process_uploaded_file(uploaded_file)
+                    if document is not None:
+                        span.set(**{"document.chars": document.size, "document.pages": document.page_count})
+                if document is None or document.size == 0:
+                    trace.end()
+                    record_trace(trace)
+                    continue
+                
+                # Documents are identified by content, so a changed file with the same name is re-processed
+                existing = st.session_state.uploaded_documents.get(uploaded_file.name)
+                if existing and existing["file_hash"] == document.file_hash:
+                    trace.root.set(**{"document.unchanged": True})
+                    trace.end()
+                    record_trace(trace)
+                    continue
+                
+                # Only a compact handle is kept in session state; text is read from disk when needed.
+                # Section hashes let a revision show what changed; unchanged sections reuse their cached analyses.
+                with trace.span("sections") as span:
+                    sections = section_hashes(document)
+                    span.set(**{"sections.count": len(sections)})
+                doc_info = {
+                    "document": document,
+                    "size": document.size,
+                    "file_hash": document.file_hash,
+                    "version": existing.get("version", 1) + 1 if existing else 1,
+                    "section_hashes": sections
+                }
+                with trace.span("index") as span:
+                    index = DocumentIndex(document)
+                    span.set(**{"index.chunks": index.chunk_count, "index.bytes": index.memory_bytes})
+                trace.end()
+                record_trace(trace)
+                budget_bytes = SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+                if session_memory_usage(exclude=uploaded_file.name) + index.memory_bytes > budget_bytes:
+                    st.error(f"❌ {uploaded_file.name} would exceed this session's {SESSION_MEMORY_BUDGET_MB:g} MB document budget. Remove a document and try again.")
+                    continue
+                
+                st.session_state.uploaded_documents[uploaded_file.name] = doc_info
+                st.session_state.document_indexes[uploaded_file.name] = {
+                    "file_hash": document.file_hash,
+                    "index": index
+                }
+                if existing:
+                    diff = diff_sections(existing.get("section_hashes", []), sections)
+                    st.success(f"✅ {uploaded_file.name} updated to version {doc_info['version']}: {diff['changed']} of {len(sections)} sections new or changed")
+                else:
+                    st.success(f"✅ {uploaded_file.name} processed successfully")
     
     # Display uploaded documents
-    if "uploaded_documents" in st.session_state and st.session_state.uploaded_documents:
-        st.header("📚 Uploaded Documents")
-        for doc_name, doc_info in st.session_state.uploaded_documents.items():
-            with st.expander(f"📄 {doc_name} ({doc_info['size']} chars)"):
-                st.text_area("Content preview:", doc_info["content"][:500] + "..." if len(doc_info["content"]) > 500 else doc_info["content"], height=100, disabled=True)
-                if st.button(f"🗑️ Remove {doc_name}", key=f"remove_{doc_name}"):
-                    del st.session_state.uploaded_documents[doc_name]
-                    st.rerun()
+    show_uploaded_documents()
     
-    st.header("🔍 Context Filters")
-    
-    selected_states = st.multiselect("Select States", STATES, default=[])
-    selected_grade = st.selectbox("Select Grade Level", ["All Grades"] + GRADE_LEVELS)
-    selected_subject = st.selectbox("Select Subject", ["All Subjects"] + SUBJECTS)
+    context_filters()
     
     st.header("⚙️ Settings")
+    stream_responses = st.toggle("Stream responses", value=True, help="Show model output as it is generated")
+    analysis_mode = st.radio(
+        "Document analysis",
+        [PASSAGES_MODE, FULL_DOCUMENT_MODE],
+        format_func={PASSAGES_MODE: "Relevant passages", FULL_DOCUMENT_MODE: "Full document"}.get,
+        help="Full document analyzes every page; documents too large for one prompt are analyzed in sections in parallel"
+    )
+    show_debug = st.toggle("Show debug info", value=False, help="Show knowledge base metadata with each response")
+    
     if st.button("Clear Chat History"):
-        st.session_state.messages = []
+        chat_history.clear()
+        st.session_state.history_window = CHAT_HISTORY_PAGE_SIZE
         st.rerun()
     
     if st.button("Clear All Documents"):
         if "uploaded_documents" in st.session_state:
             st.session_state.uploaded_documents = {}
+        st.session_state.document_indexes = {}
         st.rerun()
     
     # Pipeline Execution History
-    st.subheader("📊 Pipeline History")
-    if "pipeline_logs" in st.session_state and st.session_state.pipeline_logs:
-        for i, log in enumerate(reversed(st.session_state.pipeline_logs[-3:])):  # Show last 3
-            with st.expander(f"Execution #{len(st.session_state.pipeline_logs) - i} - {log['timestamp']}", expanded=(i==0)):
-                for stage_info in log["stages"]:
-                    if stage_info["type"] == "info":
-                        st.info(f"{stage_info['stage']}: {stage_info['status']}")
-                    elif stage_info["type"] == "success":
-                        st.success(f"{stage_info['stage']}: {stage_info['status']}")
-                
-                if log["documents_count"] > 0:
-                    st.info(f"📄 {log['documents_count']} documents processed")
-                
-                # Show a preview of the response
-                if "response" in log:
-                    response_preview = log["response"][:200] + "..." if len(log["response"]) > 200 else log["response"]
-                    st.text_area("Response Preview", response_preview, height=100, disabled=True)
-    else:
-        st.info("No pipeline executions yet")
-
-@st.cache_resource
-def get_rag_client() -> Any:
-  """Client for RAG (Knowledge Base) operations"""
-  return boto3.client(
-    'bedrock-agent-runtime',
-    region_name=os.getenv('AWS_DEFAULT_REGION', 'us-west-2')
-  )
-
-@st.cache_resource
-def get_bedrock_client() -> Any:
-  """Client for regular Bedrock LLM operations"""
-  return boto3.client(
-    'bedrock-runtime',
-    region_name=os.getenv('AWS_DEFAULT_REGION', 'us-west-2')
-  )
-
-def invoke_model(messages: List[Dict[str, str]], context: Dict[str, str] = None) -> str:
-  # Get the latest user message
-  user_message = messages[-1]["content"] if messages else ""
-
-  # Build filter context
-  filter_context_parts = []
-  if context:
-    if context.get("states") and len(context["states"]) > 0:
-      states_str = ", ".join(context["states"])
-      filter_context_parts.append(f"States: {states_str}")
-    if context.get("grade") and context["grade"] != "All Grades":
-      filter_context_parts.append(f"Grade Level: {context['grade']}")
-    if context.get("subject") and context["subject"] != "All Subjects":
-      filter_context_parts.append(f"Subject: {context['subject']}")
-  
-  st.info("🚀 **STARTING PARALLEL PROCESSING** - Two paths: State Requirements & RAG Knowledge Base")
-  
-  # PATH 1: State Requirements PDF → LLM
-  state_requirements_response = ""
-  if context and context.get("documents"):
-    st.info("📄 **PATH 1: STATE REQUIREMENTS ANALYSIS** - Processing uploaded PDF...")
-    try:
-      bedrock_client = get_bedrock_client()
-      
-      # Process each uploaded document (state requirements)
-      for name, content in context["documents"].items():
-        state_prompt = f"""Analyze the following state requirements document and provide feedback on how it relates to the user's question.
-
-DOCUMENT: {name}
-CONTENT: {content}
-
-USER QUESTION: {user_message}
-FILTER CONTEXT: {', '.join(filter_context_parts) if filter_context_parts else 'No specific filters'}
+    show_pipeline_history(chat_history)
+
+@st.fragment
+def show_governor_metrics() -> None:
+  """Process-wide load: background analyses, and queued and running Bedrock calls with their wait times and throttling"""
+  job_counts = get_job_queue().stats()
+  st.caption(f"🧵 Analyses: {job_counts['running']} running, {job_counts['queued']} waiting for a worker")
+  # Clients are created with the first question; until then there is nothing to show
+  if not GOVERNORS:
+    st.caption("No Bedrock calls yet")
+  for governor in list(GOVERNORS.values()):
+    metrics = governor.metrics()
+    st.markdown(f"**{governor.name}**")
+    queued, running, wait, throttled = st.columns(4)
+    queued.metric("Queued", metrics["queue_depth"], help=f"Peak: {metrics['max_queue_depth']}")
+    running.metric("In flight", f"{metrics['in_flight']}/{metrics['max_concurrency']}")
+    wait.metric("Wait p95", f"{metrics['wait_p95_ms']:.0f} ms", help=f"p50: {metrics['wait_p50_ms']:.0f} ms")
+    throttled.metric("Throttled", metrics["throttled_attempts"], help=f"{metrics['requests']} calls, {metrics['failures']} failed")
+  st.button("🔄 Refresh", key="refresh_bedrock_load")
 
-Please provide:
-1. Key requirements from the document
-2. How these requirements relate to the user's question
-3. Specific feedback on alignment or gaps
-4. Recommendations based on the state requirements
-
-Focus on being specific and citing exact requirements from the document."""
+with st.sidebar:
+  with st.expander("🚦 Bedrock Load"):
+    show_governor_metrics()
+
+def show_retrieval_debug(retrieved_docs: List[Dict[str, Any]]) -> None:
+  """Debug: Show ALL metadata information"""
+  st.info("🔍 **DEBUG: Complete Knowledge Base Metadata**")
+  for i, doc in enumerate(retrieved_docs[:3]):  # Show first 3 for debugging
+    metadata = doc.get('metadata', {})
+
+    # Show ALL metadata fields
+    st.markdown(f"**Document {i+1} Complete Metadata:**")
+    for key, value in metadata.items():
+      st.text(f"  {key}: {value}")
+
+    # Check for URLs in various possible fields (including AWS Bedrock specific fields)
+    url_found = False
+    possible_url_fields = ['x-amz-bedrock-kb-source-uri', 'url', 'source', 'uri', 'link', 'href', 'web_url', 'document_uri', 'file_uri']
+
+    for field in possible_url_fields:
+      if field in metadata and metadata[field]:
+        if 'http' in str(metadata[field]):
+          st.success(f"✅ Document {i+1} has URL in '{field}': {metadata[field]}")
+          url_found = True
+          break
 
-        state_messages = [{"role": "user", "content": [{"text": state_prompt}]}]
-        
-        state_response = bedrock_client.converse(
-          modelId="anthropic.claude-3-5-sonnet-20241022-v2:0",
-          messages=state_messages,
-          inferenceConfig={"maxTokens": 1500}
-        )
-        
-        state_requirements_response += f"\n\n--- ANALYSIS OF {name} ---\n"
-        state_requirements_response += state_response['output']['message']['content'][0]['text']
-      
-      st.success("✅ **PATH 1 COMPLETE** - State requirements analyzed")
-      
-    except Exception as e:
-      state_requirements_response = f"Error analyzing state requirements: {str(e)}"
-      st.error(f"❌ **PATH 1 ERROR** - {str(e)}")
-  
-  # PATH 2: User Prompt → RAG → Knowledge Base → LLM
-  st.info("🔍 **PATH 2: RAG KNOWLEDGE BASE SEARCH** - Searching for matches...")
-  
-  knowledge_base_matches = {}
-  knowledge_base_response = ""
-  try:
-    rag_client = get_rag_client()
-    bedrock_client = get_bedrock_client()
-    
-    # Use RAG to retrieve relevant documents from knowledge base
-    retrieval_response = rag_client.retrieve(
-      knowledgeBaseId=os.getenv('KNOWLEDGE_BASE_ID'),
-      retrievalQuery={'text': user_message},
-      retrievalConfiguration={
-        'vectorSearchConfiguration': {
-          'numberOfResults': 5
-        }
-      }
+    if not url_found:
+      st.warning(f"⚠️ Document {i+1} has no URL in any metadata field")
+      st.text(f"Available fields: {list(metadata.keys())}")
+
+    st.markdown("---")
+
+def submit_pipeline_job(user_message: str, context: Dict[str, Any], stream: bool) -> str:
+  """Queue a pipeline run and return its job ID.
+
+  The shared clients and caches are looked up here, on the script thread, and
+  handed to the job, so the worker never calls into Streamlit.
+  """
+  bedrock_client = get_bedrock_client()
+  rag_client = get_rag_client()
+  analysis_cache = get_analysis_cache()
+  retrieval_cache = get_retrieval_cache()
+  exporter = get_trace_exporter()
+
+  def run(listener: PipelineListener) -> Dict[str, Any]:
+    run_stats = {}
+    trace = Trace("pipeline")
+    started_at = time.strftime("%H:%M:%S")
+    response = run_pipeline(
+      user_message,
+      context,
+      bedrock_client=bedrock_client,
+      rag_client=rag_client,
+      analysis_cache=analysis_cache,
+      retrieval_cache=retrieval_cache,
+      listener=listener,
+      stream=stream,
+      stats=run_stats,
+      trace=trace
     )
-    
-    # Extract retrieved documents and create key-value pairs
-    retrieved_docs = retrieval_response.get('retrievalResults', [])
-    
-    for i, doc in enumerate(retrieved_docs):
-      # Extract comprehensive source information
-      metadata = doc.get('metadata', {})
-      source = metadata.get('source', 'Knowledge Base Document')
-      location = metadata.get('location', '')
-      
-      # Try to extract more detailed information from various possible fields
-      title = metadata.get('title', '') or metadata.get('name', '') or metadata.get('document_title', '')
-      
-      # Look for URLs in multiple possible fields (including AWS Bedrock specific fields)
-      url = ''
-      possible_url_fields = ['x-amz-bedrock-kb-source-uri', 'url', 'source', 'uri', 'link', 'href', 'web_url', 'document_uri', 'file_uri', 'source_uri']
-      for field in possible_url_fields:
-        if field in metadata and metadata[field] and 'http' in str(metadata[field]):
-          url = metadata[field]
-          break
-      
-      page = metadata.get('page', '') or metadata.get('page_number', '')
-      section = metadata.get('section', '') or metadata.get('chapter', '')
-      
-      # Create a more descriptive source name
-      if title:
-        source_name = title
-      elif url:
-        source_name = url.split('/')[-1] if '/' in url else url
-      elif source and source != 'Knowledge Base Document':
-        source_name = source
-      else:
-        # Try to extract meaningful info from content
-        content_preview = doc['content']['text'][:100].replace('\n', ' ')
-        if 'Filipino' in content_preview:
-          source_name = f"Filipino Immigration Source {i+1}"
-        elif 'Asian' in content_preview:
-          source_name = f"Asian American History Source {i+1}"
-        elif 'immigration' in content_preview.lower():
-          source_name = f"Immigration History Source {i+1}"
-        else:
-          source_name = f"Knowledge Base Document {i+1}"
-      
-      # Create detailed citation info
-      citation_info = {
-        'source': source_name,
-        'original_source': source,
-        'location': location,
-        'url': url,
-        'page': page,
-        'section': section,
-        'content': doc['content']['text'],
-        'match_number': i + 1,
-        'metadata': metadata
-      }
-      
-      key = f"Match {i+1}: {source_name}"
-      knowledge_base_matches[key] = citation_info
-    
-    st.success(f"📚 **PATH 2 RETRIEVAL COMPLETE** - Found {len(retrieved_docs)} matches from knowledge base")
-    
-    # Debug: Show ALL metadata information
-    if retrieved_docs:
-      st.info("🔍 **DEBUG: Complete Knowledge Base Metadata**")
-      for i, doc in enumerate(retrieved_docs[:3]):  # Show first 3 for debugging
-        metadata = doc.get('metadata', {})
-        
-        # Show ALL metadata fields
-        st.markdown(f"**Document {i+1} Complete Metadata:**")
-        for key, value in metadata.items():
-          st.text(f"  {key}: {value}")
-        
-        # Check for URLs in various possible fields (including AWS Bedrock specific fields)
-        url_found = False
-        possible_url_fields = ['x-amz-bedrock-kb-source-uri', 'url', 'source', 'uri', 'link', 'href', 'web_url', 'document_uri', 'file_uri']
-        
-        for field in possible_url_fields:
-          if field in metadata and metadata[field]:
-            if 'http' in str(metadata[field]):
-              st.success(f"✅ Document {i+1} has URL in '{field}': {metadata[field]}")
-              url_found = True
-              break
-        
-        if not url_found:
-          st.warning(f"⚠️ Document {i+1} has no URL in any metadata field")
-          st.text(f"Available fields: {list(metadata.keys())}")
-        
-        st.markdown("---")
-    
-    # Send matches to LLM for feedback
-    if knowledge_base_matches:
-      st.info("🤖 **PATH 2: LLM FEEDBACK** - Processing knowledge base matches...")
-      
-      # Format matches with citation information
-      matches_text = ""
-      citations_list = []
-      
-      for key, citation_info in knowledge_base_matches.items():
-        matches_text += f"{key}:\nSource: {citation_info['source']}\nLocation: {citation_info['location']}\nURL: {citation_info['url']}\nContent: {citation_info['content']}\n\n"
-        
-        # Create clickable citation with URL if available
-        if citation_info['url']:
-          citations_list.append(f"[{citation_info['match_number']}] {citation_info['source']} - {citation_info['location']} | URL: {citation_info['url']}")
-        else:
-          citations_list.append(f"[{citation_info['match_number']}] {citation_info['source']} - {citation_info['location']}")
-      
-      knowledge_prompt = f"""Based on the following matches from our knowledge base, provide feedback on the user's question.
-
-USER QUESTION: {user_message}
-FILTER CONTEXT: {', '.join(filter_context_parts) if filter_context_parts else 'No specific filters'}
-
-KNOWLEDGE BASE MATCHES:
-{matches_text}
-
-STATE STANDARDS SUMMARY:
-{state_requirements_response}
-
-Please provide:
-1. Specific feedback using the knowledge base content
-2. Quote relevant sections with proper citations (use format: "Quote text" [Citation #])
-3. Explain how the matches relate to the user's question
-4. Highlight key insights from the knowledge base
-
-CITATION FORMAT: When quoting, use this format: "Exact quote text" [1] where the number refers to the citation list below.
-
-CITATIONS:
-{chr(10).join(citations_list)}
-
-CRITICAL: Always provide proper citations with [number] format when referencing knowledge base content."""
-
-      knowledge_messages = [{"role": "user", "content": [{"text": knowledge_prompt}]}]
-      
-      knowledge_response = bedrock_client.converse(
-        modelId="anthropic.claude-3-5-sonnet-20241022-v2:0",
-        messages=knowledge_messages,
-        inferenceConfig={"maxTokens": 1500}
-      )
-      
-      knowledge_base_response = knowledge_response['output']['message']['content'][0]['text']
-      st.success("✅ **PATH 2 COMPLETE** - Knowledge base matches processed")
-
-  except Exception as e:
-    knowledge_base_response = f"Error processing knowledge base: {str(e)}"
-    st.error(f"❌ **PATH 2 ERROR** - {str(e)}")
-  
-  # COMBINE BOTH RESPONSES
-  st.info("🔄 **COMBINING RESPONSES** - Merging both analyses...")
-  
-  # Create citations section if we have knowledge base matches
-  citations_section = ""
-  if knowledge_base_matches:
-    citations_section = "\n\n## 📚 CITATIONS\n"
-    citations_section += "*Sources retrieved from AWS Bedrock Knowledge Base*\n\n"
-    
-    # Add debug information about metadata
-    citations_section += "\n### 🔍 **METADATA DEBUG INFO**\n"
-    citations_section += "*This shows what metadata fields are available in your knowledge base*\n\n"
-    
-    for i, citation_info in enumerate(knowledge_base_matches.values()):
-      citations_section += f"**Document {i+1} Metadata Fields:**\n"
-      metadata = citation_info.get('metadata', {})
-      for key, value in metadata.items():
-        citations_section += f"  - {key}: {value}\n"
-      citations_section += "\n"
-    
-    citations_section += "### 📖 **CITATIONS**\n\n"
-    
-    for citation_info in knowledge_base_matches.values():
-      if citation_info['url'] and citation_info['url'].startswith('http'):
-        # Create clickable hyperlink
-        citations_section += f"[{citation_info['match_number']}] [{citation_info['source']}]({citation_info['url']})\n\n"
-      else:
-        # Provide more context for knowledge base sources
-        content_preview = citation_info['content'][:150].replace('\n', ' ')
-        citations_section += f"[{citation_info['match_number']}] {citation_info['source']}\n   📄 Content Preview: {content_preview}...\n   ⚠️ *No URL available in knowledge base metadata*\n\n"
-  
-  final_response = f"""# ANALYSIS RESULTS
-
-## 📄 STATE REQUIREMENTS ANALYSIS
-{state_requirements_response if state_requirements_response else "No state requirements documents provided."}
-
-## 🗄️ KNOWLEDGE BASE ANALYSIS  
-{knowledge_base_response if knowledge_base_response else "No knowledge base matches found."}
-
-## 🎯 SUMMARY
-Based on both the state requirements and knowledge base analysis, here are the key findings and recommendations for your question: "{user_message}"
-{citations_section}
-"""
-  
-  st.success("✅ **FINAL RESPONSE GENERATED** - Both paths completed successfully")
-  
-  return final_response
-
-if "messages" not in st.session_state:
-  st.session_state.messages = []
-
-for message in st.session_state.messages:
+    # Written here so the trace file is complete even for jobs nobody comes back to
+    if exporter is not None:
+      exporter.export(trace)
+    return {
+      "response": response,
+      "debug": run_stats.get("metadata_debug"),
+      "log": build_pipeline_log(run_stats, trace, started_at, len(context.get("documents", {}))),
+      "trace": trace
+    }
+
+  return get_job_queue().submit(user_message, run)
+
+def stop_following_job() -> None:
+  st.session_state.active_job = None
+  st.query_params.pop("job", None)
+
+def finish_job(job: Dict[str, Any]) -> None:
+  """Store a finished job's response, with its log and debug metadata, in the chat history"""
+  if job["status"] == DONE:
+    chat_history.append("assistant", job["response"], debug=job.get("debug"), log=job.get("log"))
+    # The trace object is only kept by the process that ran the job
+    if job.get("trace") is not None:
+      record_trace(job["trace"], export=False)
+  else:
+    chat_history.append("assistant", f"❌ The analysis failed: {job['error']}")
+  get_job_queue().collect(job["id"])
+  stop_following_job()
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id: str) -> None:
+  """Progress and partial results of the running job, refreshed until it finishes"""
+  job = get_job_queue().get(job_id)
+  if job is None:
+    chat_history.append("assistant", "⚠️ This analysis is no longer available; please ask the question again.")
+    stop_following_job()
+    st.rerun()
+  if job["status"] in FINISHED:
+    finish_job(job)
+    st.rerun() # the whole page, so the response moves into the history
+
+  if job["status"] == QUEUED:
+    st.caption(f"⏳ Waiting for a free worker ({time.time() - job['created_at']:.0f}s)")
+  else:
+    st.caption(f"⏳ Running for {time.time() - job['started_at']:.0f}s · you can leave this page and open this link again later for the result")
+  for level, message in job["events"]:
+    {"info": st.info, "success": st.success, "warning": st.warning, "error": st.error}[level](message)
+  if show_debug and job["retrieved"]:
+    show_retrieval_debug(job["retrieved"])
+
+  # PATH 1 and PATH 2 results appear as they finish, or as they stream in
+  for name, analysis in job["documents"].items():
+    st.markdown(f"**{section_heading(name)}**" + (" ✅" if name in job["completed"] else ""))
+    if analysis:
+      st.markdown(analysis)
+  if job["synthesis"]:
+    st.markdown("**🗄️ KNOWLEDGE BASE ANALYSIS**")
+    st.markdown(job["synthesis"])
+
+# Only the newest page(s) of history are rendered; older turns load on request
+if "history_window" not in st.session_state:
+  st.session_state.history_window = CHAT_HISTORY_PAGE_SIZE
+
+history_start = max(0, len(chat_history) - st.session_state.history_window)
+if history_start > 0:
+  if st.button(f"⬆️ Show earlier messages ({history_start} more)"):
+    st.session_state.history_window += CHAT_HISTORY_PAGE_SIZE
+    st.rerun()
+
+for message in chat_history.page(history_start, len(chat_history)):
   with st.chat_message(message["role"]):
     st.write(message["content"])
-
-if prompt := st.chat_input("Type your message here..."):
-  st.session_state.messages.append({"role": "user", "content": prompt})
-  
-  with st.chat_message("user"):
-    st.write(prompt)
-  
+    if show_debug and message.get("debug"):
+      with st.expander("🔍 Metadata debug info"):
+        st.markdown(message["debug"])
+
+job_running = st.session_state.active_job is not None
+if prompt := st.chat_input("Waiting for the current analysis..." if job_running else "Type your message here...", disabled=job_running):
+  chat_history.append("user", prompt)
+
+  # Pass filter context to the AI model
+  context = {
+    "states": st.session_state.selected_states,
+    "grade": st.session_state.selected_grade,
+    "subject": st.session_state.selected_subject,
+    "analysis_mode": analysis_mode
+  }
+
+  # Add document content if available: library standards for the selected states, then uploads
+  library_documents = get_library_documents(context["states"], context["subject"])
+  documents = {name: document for name, (document, _) in library_documents.items()}
+  document_indexes = {name: index for name, (_, index) in library_documents.items()}
+  if "uploaded_documents" in st.session_state and st.session_state.uploaded_documents:
+    documents.update({name: doc_info["document"] for name, doc_info in st.session_state.uploaded_documents.items()})
+    document_indexes.update({name: get_document_index(name, doc_info) for name, doc_info in st.session_state.uploaded_documents.items()})
+  if documents:
+    context["documents"] = documents
+    context["document_indexes"] = document_indexes
+
+  st.session_state.active_job = submit_pipeline_job(prompt, context, stream_responses)
+  st.query_params["job"] = st.session_state.active_job
+  st.rerun() # show the question and start following the job
+
+if st.session_state.active_job is not None:
   with st.chat_message("assistant"):
-    # Store pipeline logs in session state for persistence
-    if "pipeline_logs" not in st.session_state:
-      st.session_state.pipeline_logs = []
-    
-    # Pass filter context to the AI model
-    context = {
-      "states": selected_states,
-      "grade": selected_grade,
-      "subject": selected_subject
-    }
-    
-    # Add document content if available
-    if "uploaded_documents" in st.session_state and st.session_state.uploaded_documents:
-      context["documents"] = {name: doc_info["content"] for name, doc_info in st.session_state.uploaded_documents.items()}
-    
-    # Add pipeline logs for this interaction
-    pipeline_log = {
-      "timestamp": "Just now",
-      "stages": [
-        {"stage": "🔄 STAGE 1: INPUT PROCESSING", "status": "✅ Input received and context prepared", "type": "info"},
-        {"stage": "📄 PATH 1: STATE REQUIREMENTS", "status": "🚀 Processing uploaded PDF with LLM", "type": "info"},
-        {"stage": "🔍 PATH 2: RAG KNOWLEDGE BASE", "status": "🚀 Searching knowledge base for matches", "type": "info"},
-        {"stage": "🤖 PATH 2: LLM FEEDBACK", "status": "🚀 Processing knowledge base matches", "type": "info"},
-        {"stage": "🔄 COMBINING RESPONSES", "status": "🚀 Merging both analyses", "type": "info"},
-        {"stage": "📤 FINAL OUTPUT", "status": "✅ Response generated with proper attribution", "type": "success"}
-      ],
-      "documents_count": len(context.get("documents", {}))
-    }
-    
-    with st.spinner("🔍 Querying knowledge base with filters..."):
-      final_response = invoke_model(st.session_state.messages, context)
-    
-    # Add the response to pipeline log
-    pipeline_log["response"] = final_response
-    st.session_state.pipeline_logs.append(pipeline_log)
-    
-    # Display persistent pipeline logs
-    st.markdown("### 📊 **PIPELINE EXECUTION LOG**")
-    
-    # Show the most recent pipeline execution
-    if st.session_state.pipeline_logs:
-      latest_log = st.session_state.pipeline_logs[-1]
-      
-      for stage_info in latest_log["stages"]:
-        if stage_info["type"] == "info":
-          st.info(f"{stage_info['stage']}: {stage_info['status']}")
-        elif stage_info["type"] == "success":
-          st.success(f"{stage_info['stage']}: {stage_info['status']}")
-      
-      if latest_log["documents_count"] > 0:
-        st.info(f"📄 {latest_log['documents_count']} uploaded documents processed")
-    
-    # Show the final response
-    st.markdown("**📋 PIPELINE RESULTS:**")
-    st.write(final_response)
-
-  st.session_state.messages.append({"role": "assistant", "content": final_response})
-  st.rerun() # refresh the app to show the new message 
-             # updating session state does not automatically refresh the UI
+    show_job_progress(st.session_state.active_job)
@@ -0,0 +1,204 @@
+"""Headless batch runs of the alignment pipeline.
+
+Reads a JSONL file of queries and writes one JSONL result per query with the
+response, cache counters, per-stage timings and token usage:
+
+    python batch_eval.py queries.jsonl -o results.jsonl --concurrency 4
+    python batch_eval.py queries.jsonl --stub          # offline, no AWS calls
+
+Each query line looks like:
+
+    {"id": "ca-8", "question": "...", "states": ["California"], "grade": "8th Grade",
+     "subject": "U.S. History", "documents": ["standards/ca_framework.pdf"]}
+
+Only "question" is required; "analysis_mode" overrides --analysis-mode per query. --expand-states-grades runs every query once per
+state and grade level combination. Standards library documents of the selected
+states are attached to each query as they are in the app.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List
+
+from caching import AnalysisCache, RetrievalCache
+from document_index import DocumentIndex
+from document_store import DocumentStore
+from extraction import file_type_for_path
+from pipeline import FULL_DOCUMENT_MODE, PASSAGES_MODE, PipelineListener, run_pipeline
+from reference_data import GRADE_LEVELS, STATES
+from standards_library import LIBRARY_DIR, StandardsLibrary
+from telemetry import Trace, TraceExporter
+
+logger = logging.getLogger("batch_eval")
+
+
+class LoggingListener(PipelineListener):
+    """Logs pipeline status lines, tagged with the query ID"""
+
+    def __init__(self, query_id: str):
+        self.query_id = query_id
+
+    def status(self, level: str, message: str) -> None:
+        log_level = {"warning": logging.WARNING, "error": logging.ERROR}.get(level, logging.INFO)
+        logger.log(log_level, "[%s] %s", self.query_id, message.replace("**", ""))
+
+
+def read_queries(path: str, expand_states_grades: bool = False) -> Iterator[Dict[str, Any]]:
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            query = json.loads(line)
+            query.setdefault("id", str(line_number))
+            if not expand_states_grades:
+                yield query
+                continue
+            for state in STATES:
+                for grade in GRADE_LEVELS:
+                    yield dict(query, id=f"{query['id']}:{state}:{grade}", states=[state], grade=grade)
+
+
+def load_documents(paths: List[str], store: DocumentStore) -> Dict[str, Dict[str, Any]]:
+    """Extract and index every referenced document once"""
+    documents = {}
+    for path in paths:
+        if path in documents:
+            continue
+        started = time.perf_counter()
+        document = store.ingest_path(path, file_type_for_path(path))
+        documents[path] = {"document": document, "index": DocumentIndex(document)}
+        logger.info("Loaded %s (%d chars, %d pages) in %.2fs", path, document.size, document.page_count,
+                    time.perf_counter() - started)
+    return documents
+
+
+def run_query(query: Dict[str, Any], documents: Dict[str, Dict[str, Any]], clients: Dict[str, Any],
+              stream: bool, analysis_mode: str = PASSAGES_MODE) -> Dict[str, Any]:
+    context = {
+        "states": query.get("states", []),
+        "grade": query.get("grade", "All Grades"),
+        "subject": query.get("subject", "All Subjects"),
+        "analysis_mode": query.get("analysis_mode", analysis_mode)
+    }
+    library_documents = {}
+    if clients["library"] is not None and context["states"]:
+        library_documents = clients["library"].documents_for(context["states"], context["subject"])
+    if query.get("documents") or library_documents:
+        context["documents"] = {name: document for name, (document, _) in library_documents.items()}
+        context["document_indexes"] = {name: index for name, (_, index) in library_documents.items()}
+        for path in query.get("documents", []):
+            context["documents"][path] = documents[path]["document"]
+            context["document_indexes"][path] = documents[path]["index"]
+
+    stats: Dict[str, Any] = {}
+    trace = Trace("pipeline", **{"query.id": query["id"]})
+    result = {"id": query["id"], "question": query["question"], "filters": context.copy(), "documents": query.get("documents", []),
+              "library_documents": list(library_documents)}
+    result["filters"].pop("documents", None)
+    result["filters"].pop("document_indexes", None)
+
+    started = time.perf_counter()
+    try:
+        result["response"] = run_pipeline(
+            query["question"],
+            context,
+            bedrock_client=clients["bedrock"],
+            rag_client=clients["rag"],
+            analysis_cache=clients["analysis_cache"],
+            retrieval_cache=clients["retrieval_cache"],
+            listener=LoggingListener(query["id"]),
+            stream=stream,
+            stats=stats,
+            trace=trace
+        )
+        result["error"] = None
+    except Exception as e:
+        logger.exception("[%s] failed", query["id"])
+        result["response"] = None
+        result["error"] = str(e)
+    result["elapsed_seconds"] = time.perf_counter() - started
+    result["timings"] = stats.pop("timings", {})
+    result["usage"] = stats.pop("usage", trace.usage())
+    result["stats"] = stats
+    result["spans"] = trace.summary()
+    if clients["trace_exporter"] is not None:
+        clients["trace_exporter"].export(trace)
+    return result
+
+
+def build_clients(stub: bool, stub_latency: float, trace_path: str = None, library_dir: str = LIBRARY_DIR) -> Dict[str, Any]:
+    if stub:
+        from governor import GovernedClient, Governor
+        from stub_clients import StubBedrockClient, StubRagClient
+        # Stubs go through the same governors as the real clients
+        bedrock_client = GovernedClient(StubBedrockClient(latency=stub_latency), Governor.from_env("Bedrock runtime", "BEDROCK", 8))
+        rag_client = GovernedClient(StubRagClient(latency=stub_latency), Governor.from_env("Knowledge base", "RETRIEVE", 4))
+    else:
+        from clients import create_bedrock_client, create_rag_client
+        bedrock_client, rag_client = create_bedrock_client(), create_rag_client()
+    return {
+        "bedrock": bedrock_client,
+        "rag": rag_client,
+        "analysis_cache": AnalysisCache.from_env(),
+        "retrieval_cache": RetrievalCache.from_env(),
+        "trace_exporter": TraceExporter(trace_path) if trace_path else TraceExporter.from_env(),
+        "library": StandardsLibrary(library_dir) if library_dir and os.path.isdir(library_dir) else None
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the alignment pipeline over a JSONL file of queries.")
+    parser.add_argument("queries", help="JSONL file with one query per line")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results file (default: stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Queries run at the same time (default: 4)")
+    parser.add_argument("--expand-states-grades", action="store_true", help="Run each query for every state and grade level")
+    parser.add_argument("--analysis-mode", choices=[PASSAGES_MODE, FULL_DOCUMENT_MODE], default=PASSAGES_MODE,
+                        help="Analyze the most relevant passages or whole documents (default: passages)")
+    parser.add_argument("--stream", action="store_true", help="Use converse_stream for model calls")
+    parser.add_argument("--stub", action="store_true", help="Use local stub clients instead of AWS Bedrock")
+    parser.add_argument("--stub-latency", type=float, default=0.2, help="Seconds each stub call takes (default: 0.2)")
+    parser.add_argument("--library", default=LIBRARY_DIR,
+                        help=f"Standards library directory; empty to attach no library documents (default: {LIBRARY_DIR})")
+    parser.add_argument("--traces", help="Append OTLP/JSON traces to this file (default: TRACE_EXPORT_PATH)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log pipeline progress")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(message)s")
+
+    queries = list(read_queries(args.queries, args.expand_states_grades))
+    documents = load_documents([path for query in queries for path in query.get("documents", [])], DocumentStore())
+    clients = build_clients(args.stub, args.stub_latency, args.traces, args.library)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    write_lock = threading.Lock()
+    failures = 0
+    started = time.perf_counter()
+    try:
+        def run_and_write(query):
+            result = run_query(query, documents, clients, args.stream, args.analysis_mode)
+            with write_lock:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+            for result in executor.map(run_and_write, queries):
+                failures += result["error"] is not None
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    logger.warning("%d queries in %.2fs, %d failed", len(queries), time.perf_counter() - started, failures)
+    for client in (clients["bedrock"], clients["rag"]):
+        if hasattr(client, "governor"):
+            logger.warning("%s load: %s", client.governor.name, json.dumps(client.governor.metrics()))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
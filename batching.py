@@ -0,0 +1,103 @@
+"""Packing small documents into shared PATH 1 analysis calls.
+
+Most of the time of a model call on a two-page excerpt is fixed overhead, so
+small documents are packed, up to a token budget, into one request that asks
+for a separately headed analysis of each document. The response is then split
+back into per-document analyses at those headings.
+
+Whether a document is small is decided by the size of the whole document, not
+of the passages sent for it: the answer about a large binder is long however
+few of its passages are sent, and the answers in a batch are generated one
+after another. Larger documents keep their own, parallel calls.
+
+Because those answers are no longer generated in parallel, a batch is slower
+than separate calls whenever the calls can run concurrently (see the batching
+benchmark suite). Batching is therefore off unless BATCH_DOCUMENT_TOKENS is
+set. It pays off when calls are the scarce resource, under a tight
+BEDROCK_REQUESTS_PER_MINUTE quota, for example.
+"""
+import os
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Documents whose whole text is estimated at or below this many tokens may share a call; 0 turns batching off
+BATCH_DOCUMENT_TOKENS = int(os.getenv("BATCH_DOCUMENT_TOKENS", "0"))
+
+# Estimated content tokens of one batched call, and its most documents
+BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", "12000"))
+BATCH_MAX_DOCUMENTS = int(os.getenv("BATCH_MAX_DOCUMENTS", "5"))
+
+
+def section_heading(name: str) -> str:
+    """Line that starts the analysis of one document, in responses and in the final answer"""
+    return f"--- ANALYSIS OF {name} ---"
+
+
+def plan_batches(items: Sequence[Tuple[str, int]], token_budget: int = BATCH_TOKEN_BUDGET,
+                 max_documents: int = BATCH_MAX_DOCUMENTS) -> List[List[str]]:
+    """Group (name, estimated tokens) items into batches of names.
+
+    Items are packed first-fit in decreasing size, so each batch stays within
+    token_budget and max_documents. Batches of one name are analyzed alone.
+    """
+    batches: List[List[str]] = []
+    loads: List[int] = []
+    for name, tokens in sorted(items, key=lambda item: -item[1]):
+        for i, batch in enumerate(batches):
+            if len(batch) < max_documents and loads[i] + tokens <= token_budget:
+                batch.append(name)
+                loads[i] += tokens
+                break
+        else:
+            batches.append([name])
+            loads.append(tokens)
+    # Keep upload order within each batch, and the batches in order of their first document
+    order = {name: i for i, (name, _) in enumerate(items)}
+    for batch in batches:
+        batch.sort(key=order.get)
+    return sorted(batches, key=lambda batch: order[batch[0]])
+
+
+def _heading_pattern(names: Sequence[str]) -> "re.Pattern":
+    alternatives = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+    return re.compile(rf"^[ \t#*]*-{{3}} ANALYSIS OF ({alternatives}) -{{3}}[ \t*]*$", re.MULTILINE)
+
+
+def split_analyses(text: str, names: Sequence[str]) -> Dict[str, str]:
+    """Per-document analyses of a batched response; documents without a heading are left out"""
+    matches = list(_heading_pattern(names).finditer(text))
+    analyses: Dict[str, str] = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(text)
+        section = text[match.end():end].strip()
+        # A repeated heading continues the same document
+        analyses[match.group(1)] = f"{analyses[match.group(1)]}\n\n{section}" if match.group(1) in analyses else section
+    return {name: section for name, section in analyses.items() if section}
+
+
+class SectionRouter:
+    """Splits a streamed batched response into per-document deltas, a line at a time"""
+
+    def __init__(self, names: Sequence[str], emit: Callable[[str, str], None]):
+        self._pattern = _heading_pattern(names)
+        self._emit = emit
+        self._current: Optional[str] = None
+        self._pending = ""
+
+    def feed(self, text: str) -> None:
+        self._pending += text
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            self._route(line + "\n")
+
+    def close(self) -> None:
+        if self._pending:
+            self._route(self._pending)
+            self._pending = ""
+
+    def _route(self, line: str) -> None:
+        match = self._pattern.match(line.rstrip("\n"))
+        if match:
+            self._current = match.group(1)
+        elif self._current is not None:
+            self._emit(self._current, line)
@@ -0,0 +1,397 @@
+"""Benchmarks and load tests against stubbed Bedrock backends.
+
+Every suite runs offline: the Bedrock and knowledge base clients are the
+stand-ins from stub_clients.py with a configurable fake latency and payload
+size, and documents are generated fixtures. Results are written as JSON lines
+(one per suite and parameter set, with p50/p95 in seconds) so runs can be
+compared over time:
+
+    python benchmark.py -o benchmarks.jsonl
+    python benchmark.py --suite extraction --suite sessions --quick
+
+The startup suite drives app.py with Streamlit's AppTest in fresh
+interpreters to time a cold start and a rerun of the page script.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+import docx
+
+from caching import AnalysisCache, RetrievalCache
+from document_index import DocumentIndex
+from document_store import DocumentStore
+from message_store import MessageStore
+from extraction import TXT_TYPE, extract_text_from_docx, extract_text_from_pdf
+import pipeline
+from pipeline import run_pipeline
+from stub_clients import StubBedrockClient, StubRagClient
+from telemetry import Trace
+
+SUITES = ["invoke_model", "batching", "extraction", "memory", "sessions", "startup"]
+
+# Libraries that should only be imported once an upload or a question needs them
+HEAVY_MODULES = ["boto3", "botocore", "pypdf", "docx"]
+
+# Run by a fresh interpreter: times the first run and the reruns of app.py, prints one JSON line
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+app.run()
+first_run = time.perf_counter()
+reruns = []
+for _ in range(int(sys.argv[2])):
+    rerun_started = time.perf_counter()
+    app.run()
+    reruns.append(time.perf_counter() - rerun_started)
+print(json.dumps({"streamlit_import": imported - started, "first_run": first_run - imported, "reruns": reruns,
+                  "exceptions": [e.value for e in app.exception],
+                  "heavy_modules": [name for name in sys.argv[3].split(",") if name in sys.modules]}))
+"""
+
+FIXTURE_LINE = "Students analyze primary sources on Asian American immigration history and civic participation, standard {page}.{line}"
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Linearly interpolated percentile of the samples"""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    return {
+        "n": len(samples),
+        "p50": percentile(samples, 0.5),
+        "p95": percentile(samples, 0.95),
+        "mean": sum(samples) / len(samples),
+        "min": min(samples),
+        "max": max(samples)
+    }
+
+
+def timed(fn: Callable, *args, **kwargs) -> float:
+    started = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def make_pdf(pages: int, lines_per_page: int = 40) -> bytes:
+    """Minimal text-only PDF with the given number of pages"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None]
+    font_id = 3 + 2 * pages
+    kids = []
+    for page in range(pages):
+        page_id = 3 + 2 * page
+        kids.append(f"{page_id} 0 R")
+        lines = "".join(f"({FIXTURE_LINE.format(page=page + 1, line=line + 1)}) Tj 0 -14 Td " for line in range(lines_per_page))
+        content = f"BT /F1 8 Tf 20 800 Td {lines} ET".encode("latin-1")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {page_id + 1} 0 R >>".encode("latin-1")
+        )
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode("latin-1")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def make_docx(paragraphs: int) -> bytes:
+    document = docx.Document()
+    for paragraph in range(paragraphs):
+        document.add_paragraph(FIXTURE_LINE.format(page=paragraph // 40 + 1, line=paragraph % 40 + 1))
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_text(pages: int, lines_per_page: int = 40) -> str:
+    return "\f".join(
+        "\n".join(FIXTURE_LINE.format(page=page + 1, line=line + 1) for line in range(lines_per_page))
+        for page in range(pages)
+    )
+
+
+def load_fixture_documents(store: DocumentStore, count: int, pages: int, prefix: str = "fixture") -> Dict[str, Any]:
+    """Stored and indexed TXT fixtures, as the app keeps them in session state"""
+    documents, indexes = {}, {}
+    for i in range(count):
+        # A distinct header per document so each gets its own content hash
+        data = (f"{prefix.capitalize()} document {i}\n" + make_text(pages)).encode("utf-8")
+        document = store.ingest(io.BytesIO(data), TXT_TYPE)
+        documents[f"{prefix}_{i}.txt"] = document
+        indexes[f"{prefix}_{i}.txt"] = DocumentIndex(document)
+    return {"documents": documents, "document_indexes": indexes}
+
+
+def pipeline_context(fixtures: Dict[str, Any]) -> Dict[str, Any]:
+    context = {"states": ["California"], "grade": "8th Grade", "subject": "U.S. History"}
+    context.update(fixtures)
+    return context
+
+
+def bench_invoke_model(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """End-to-end pipeline latency (what a chat question runs) by document count and size"""
+    results = []
+    bedrock_client = StubBedrockClient(latency=args.latency, output_words=args.output_words,
+                                       output_token_latency=args.output_token_latency)
+    rag_client = StubRagClient(latency=args.latency, content_words=args.kb_words)
+    for pages in args.doc_pages:
+        for count in args.doc_counts:
+            context = pipeline_context(load_fixture_documents(store, count, pages))
+            for stream in (False, True):
+                samples = [
+                    timed(run_pipeline, f"What are the civics requirements? ({i})", context,
+                          bedrock_client=bedrock_client, rag_client=rag_client, stream=stream)
+                    for i in range(args.repeat)
+                ]
+                results.append({"params": {"documents": count, "pages_per_document": pages, "stream": stream},
+                                **summarize(samples)})
+    return results
+
+
+def bench_batching(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """Pipeline latency and model calls with and without batching, for small documents alone and beside a large one.
+
+    Stub calls take longer the more they generate, so a batch pays for every
+    answer it contains.
+    """
+    results = []
+    small = load_fixture_documents(store, 4, 1, prefix="small")
+    large = load_fixture_documents(store, 1, args.large_pages, prefix="large")
+    mixed = {key: {**large[key], **small[key]} for key in small}
+    rag_client = StubRagClient(latency=args.latency, content_words=args.kb_words)
+    batch_document_tokens = pipeline.BATCH_DOCUMENT_TOKENS
+    try:
+        for documents, fixtures in (("small", small), ("large_and_small", mixed)):
+            context = pipeline_context(fixtures)
+            for batching in (False, True):
+                # No document is small enough to share a call when the threshold is 0
+                pipeline.BATCH_DOCUMENT_TOKENS = args.batch_document_tokens if batching else 0
+                bedrock_client = StubBedrockClient(latency=args.latency, output_words=args.output_words,
+                                                   output_token_latency=args.output_token_latency)
+                samples = [
+                    timed(run_pipeline, f"What are the civics requirements? ({i})", context,
+                          bedrock_client=bedrock_client, rag_client=rag_client)
+                    for i in range(args.repeat)
+                ]
+                results.append({"params": {"documents": documents, "batching": batching}, **summarize(samples),
+                                "model_calls_per_run": bedrock_client.calls / args.repeat})
+    finally:
+        pipeline.BATCH_DOCUMENT_TOKENS = batch_document_tokens
+    return results
+
+
+def bench_extraction(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """extract_text_from_pdf / extract_text_from_docx throughput on generated fixtures"""
+    results = []
+    for pages in args.extract_pages:
+        fixtures = [
+            ("pdf", extract_text_from_pdf, make_pdf(pages)),
+            ("docx", extract_text_from_docx, make_docx(pages * 40))
+        ]
+        for kind, extractor, data in fixtures:
+            samples = [timed(extractor, data) for _ in range(args.repeat)]
+            summary = summarize(samples)
+            results.append({
+                "params": {"format": kind, "pages": pages, "bytes": len(data)},
+                **summary,
+                "pages_per_second": pages / summary["p50"],
+                "mb_per_second": len(data) / 1024 / 1024 / summary["p50"]
+            })
+    return results
+
+
+def bench_memory(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """Python heap growth across many chat turns in one session"""
+    bedrock_client = StubBedrockClient(latency=0.0, output_words=args.output_words)
+    rag_client = StubRagClient(latency=0.0, content_words=args.kb_words)
+    analysis_cache, retrieval_cache = AnalysisCache(), RetrievalCache()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    context = pipeline_context(load_fixture_documents(store, 2, args.doc_pages[0]))
+    history = MessageStore(root=os.path.join(store.root, "history"))
+    checkpoints = []
+    turn_samples = []
+    for turn in range(1, args.turns + 1):
+        # What the chat handler keeps per turn
+        question = f"How does standard {turn} align with the framework?"
+        history.append("user", question)
+        stats, trace = {}, Trace("pipeline")
+        started = time.perf_counter()
+        response = run_pipeline(question, context, bedrock_client=bedrock_client, rag_client=rag_client,
+                                analysis_cache=analysis_cache, retrieval_cache=retrieval_cache, stats=stats, trace=trace)
+        turn_samples.append(time.perf_counter() - started)
+        log = {"trace_id": trace.trace_id, "duration": stats["timings"]["total"], "usage": stats["usage"], "stages": trace.summary()}
+        history.append("assistant", response, debug=stats["metadata_debug"], log=log)
+        if turn % max(1, args.turns // 10) == 0 or turn == args.turns:
+            current, peak = tracemalloc.get_traced_memory()
+            checkpoints.append({"turn": turn, "heap_bytes": current - baseline, "peak_bytes": peak - baseline})
+    tracemalloc.stop()
+
+    growth = (checkpoints[-1]["heap_bytes"] - checkpoints[0]["heap_bytes"]) / max(1, checkpoints[-1]["turn"] - checkpoints[0]["turn"])
+    return [{
+        "params": {"turns": args.turns, "documents": 2},
+        **summarize(turn_samples),
+        "bytes_per_turn": growth,
+        "checkpoints": checkpoints
+    }]
+
+
+def bench_sessions(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """Many simulated sessions sharing the process-wide clients and caches"""
+    results = []
+    fixtures = load_fixture_documents(store, 2, args.doc_pages[0])
+    for sessions in args.sessions:
+        bedrock_client = StubBedrockClient(latency=args.latency, output_words=args.output_words,
+                                           output_token_latency=args.output_token_latency)
+        rag_client = StubRagClient(latency=args.latency, content_words=args.kb_words)
+        analysis_cache, retrieval_cache = AnalysisCache(), RetrievalCache()
+
+        def run_session(session_id):
+            context = pipeline_context(fixtures)
+            samples = []
+            for turn in range(args.session_turns):
+                # Half the sessions ask the same questions, so shared caches get exercised
+                scope = "shared" if session_id % 2 == 0 else f"session {session_id}"
+                question = f"What does standard {turn} require? ({scope})"
+                samples.append(timed(run_pipeline, question, context, bedrock_client=bedrock_client, rag_client=rag_client,
+                                     analysis_cache=analysis_cache, retrieval_cache=retrieval_cache))
+            return samples
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            samples = [sample for session_samples in executor.map(run_session, range(sessions)) for sample in session_samples]
+        wall = time.perf_counter() - started
+
+        results.append({
+            "params": {"sessions": sessions, "turns_per_session": args.session_turns},
+            **summarize(samples),
+            "wall_seconds": wall,
+            "turns_per_second": len(samples) / wall,
+            "bedrock_calls": bedrock_client.calls,
+            "retrieve_calls": rag_client.calls,
+            "analysis_cache": analysis_cache.stats(),
+            "retrieval_cache": retrieval_cache.stats()
+        })
+    return results
+
+
+def bench_startup(args, store: DocumentStore) -> List[Dict[str, Any]]:
+    """Cold start (fresh interpreter, first script run) and rerun time of the Streamlit app"""
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    reruns = 5 if args.quick else 20
+    cold_samples, first_run_samples, rerun_samples = [], [], []
+    heavy_modules = set()
+    with tempfile.TemporaryDirectory() as root:
+        env = dict(os.environ, DOCUMENT_STORE_DIR=store.root, STANDARDS_LIBRARY_DIR=os.path.join(root, "library"),
+                   CHAT_HISTORY_DIR=os.path.join(root, "history"))
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, app_path, str(reruns), ",".join(HEAVY_MODULES)],
+                                       capture_output=True, text=True, env=env, check=True)
+            cold_samples.append(time.perf_counter() - started)
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            if result["exceptions"]:
+                raise RuntimeError(f"app.py raised: {result['exceptions'][0]}")
+            first_run_samples.append(result["first_run"])
+            rerun_samples.extend(result["reruns"])
+            heavy_modules.update(result["heavy_modules"])
+
+    loaded = sorted(heavy_modules)
+    return [
+        {"params": {"phase": "cold_start"}, **summarize(cold_samples), "heavy_modules_loaded": loaded},
+        {"params": {"phase": "first_run"}, **summarize(first_run_samples), "heavy_modules_loaded": loaded},
+        {"params": {"phase": "rerun", "reruns_per_process": reruns}, **summarize(rerun_samples)}
+    ]
+
+
+BENCHMARKS = {
+    "invoke_model": bench_invoke_model,
+    "batching": bench_batching,
+    "extraction": bench_extraction,
+    "memory": bench_memory,
+    "sessions": bench_sessions,
+    "startup": bench_startup
+}
+
+
+def run_metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform()}
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against stubbed Bedrock clients.")
+    parser.add_argument("-o", "--output", default="-", help="JSONL file to append results to (default: stdout)")
+    parser.add_argument("--suite", action="append", choices=SUITES, help="Suite to run (repeatable, default: all)")
+    parser.add_argument("--quick", action="store_true", help="Small sizes for a fast smoke run")
+    parser.add_argument("--repeat", type=int, default=5, help="Samples per parameter set (default: 5)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds each stub call takes (default: 0.05)")
+    parser.add_argument("--output-token-latency", type=float, default=0.001,
+                        help="Seconds each generated stub token adds to a call (default: 0.001)")
+    parser.add_argument("--batch-document-tokens", type=int, default=3000,
+                        help="BATCH_DOCUMENT_TOKENS of the batched runs in the batching suite (default: 3000)")
+    parser.add_argument("--output-words", type=int, default=400, help="Words in each stub model response (default: 400)")
+    parser.add_argument("--kb-words", type=int, default=120, help="Words in each stub knowledge base result (default: 120)")
+    parser.add_argument("--turns", type=int, default=200, help="Chat turns for the memory suite (default: 200)")
+    parser.add_argument("--session-turns", type=int, default=3, help="Turns per simulated session (default: 3)")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.repeat = min(args.repeat, 2)
+        args.turns = min(args.turns, 20)
+        args.doc_counts, args.doc_pages, args.extract_pages, args.sessions = [0, 2], [5], [10], [1, 8]
+        args.large_pages = 50
+    else:
+        args.doc_counts, args.doc_pages, args.extract_pages, args.sessions = [0, 1, 4, 8], [5, 50], [10, 100], [1, 8, 32]
+        args.large_pages = 500
+
+    metadata = run_metadata()
+    output = sys.stdout if args.output == "-" else open(args.output, "a")
+    try:
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = DocumentStore(root=store_dir)
+            for suite in args.suite or SUITES:
+                for result in BENCHMARKS[suite](args, store):
+                    output.write(json.dumps({"suite": suite, **result, "run": metadata}) + "\n")
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
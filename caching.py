@@ -0,0 +1,212 @@
+"""Caches shared by every session of the app process."""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation insensitive form of a question"""
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?.!")
+
+
+class AnalysisCache:
+    """Content-addressed cache for per-document state requirements analyses.
+
+    Entries live in an in-memory LRU and, when db_path is given, in a SQLite
+    file capped at max_disk_bytes. Both tiers expire entries after ttl_seconds.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 7 * 24 * 3600,
+                 db_path: Optional[str] = None, max_disk_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> "AnalysisCache":
+        """Cache configured by the ANALYSIS_CACHE_* environment variables"""
+        return cls(
+            max_entries=int(os.getenv("ANALYSIS_CACHE_ENTRIES", "512")),
+            ttl_seconds=float(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "168")) * 3600,
+            db_path=os.getenv("ANALYSIS_CACHE_PATH") or None,
+            max_disk_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_MB", "256")) * 1024 * 1024
+        )
+
+    @staticmethod
+    def make_key(document_hash: str, question: str, filter_context: str, model_id: str, variant: str = "") -> str:
+        """variant distinguishes analyses of the same inputs made in different ways"""
+        parts = [document_hash, normalize_question(question), filter_context, model_id]
+        if variant:
+            parts.append(variant)
+        payload = json.dumps(parts)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM analyses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] < self.ttl_seconds:
+                    self._db.execute("UPDATE analyses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analyses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value.encode("utf-8")), now, now)
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float) -> None:
+        self._db.execute("DELETE FROM analyses WHERE created_at <= ?", (now - self.ttl_seconds,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        # Drop least recently used rows until the file is back under its cap
+        for key, size in self._db.execute("SELECT key, size FROM analyses ORDER BY accessed_at").fetchall():
+            self._db.execute("DELETE FROM analyses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_disk_bytes:
+                break
+
+
+class RetrievalCache:
+    """TTL cache for knowledge base retrievals with single-flight loading.
+
+    Concurrent lookups of a key that is not cached yet wait for the first
+    caller's request instead of issuing their own, so N identical queries
+    arriving together cost a single Retrieve call.
+    """
+
+    def __init__(self, ttl_seconds: float = 300, max_entries: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._in_flight: Dict[str, "_Flight"] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RetrievalCache":
+        """Cache configured by the RETRIEVAL_CACHE_* environment variables"""
+        return cls(
+            ttl_seconds=float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "300")),
+            max_entries=int(os.getenv("RETRIEVAL_CACHE_ENTRIES", "256"))
+        )
+
+    @staticmethod
+    def make_key(query: str, knowledge_base_id: Optional[str], retrieval_configuration: Dict[str, Any]) -> str:
+        payload = json.dumps([normalize_question(query), knowledge_base_id, retrieval_configuration], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Tuple[Any, str]:
+        """Return (value, outcome), outcome being one of hit, coalesced or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], "hit"
+            if entry is not None:
+                del self._entries[key]
+
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self._in_flight[key] = _Flight()
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, "coalesced"
+
+        try:
+            flight.value = fetch()
+        except Exception as e:
+            # Errors are shared with the waiters but never cached
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._entries[key] = (flight.value, time.time())
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+        return flight.value, "miss"
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "entries": len(self._entries)}
+
+
+class _Flight:
+    """A fetch in progress that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
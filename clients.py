@@ -0,0 +1,47 @@
+"""Factories for the AWS Bedrock clients used by the pipeline.
+
+Clients retry throttled calls with botocore's adaptive retry mode and are
+wrapped in a process-wide Governor, so create each of them once per process.
+boto3 is only imported when a client is first created.
+"""
+import os
+from typing import TYPE_CHECKING, Any
+
+from governor import GovernedClient, Governor
+
+if TYPE_CHECKING:
+  from botocore.config import Config
+
+# Attempts per call, including the first, before an error reaches the pipeline
+MAX_ATTEMPTS = int(os.getenv('BEDROCK_MAX_ATTEMPTS', '8'))
+
+def client_config(max_concurrency: int) -> "Config":
+  """Adaptive retries with jittered backoff, and a connection per concurrent call"""
+  from botocore.config import Config
+
+  return Config(
+    retries={'mode': 'adaptive', 'total_max_attempts': MAX_ATTEMPTS},
+    max_pool_connections=max_concurrency
+  )
+
+def create_rag_client() -> Any:
+  """Client for RAG (Knowledge Base) operations"""
+  import boto3
+
+  governor = Governor.from_env('Knowledge base', 'RETRIEVE', default_concurrency=4)
+  return GovernedClient(boto3.client(
+    'bedrock-agent-runtime',
+    region_name=os.getenv('AWS_DEFAULT_REGION', 'us-west-2'),
+    config=client_config(governor.max_concurrency)
+  ), governor)
+
+def create_bedrock_client() -> Any:
+  """Client for regular Bedrock LLM operations"""
+  import boto3
+
+  governor = Governor.from_env('Bedrock runtime', 'BEDROCK', default_concurrency=8)
+  return GovernedClient(boto3.client(
+    'bedrock-runtime',
+    region_name=os.getenv('AWS_DEFAULT_REGION', 'us-west-2'),
+    config=client_config(governor.max_concurrency)
+  ), governor)
@@ -0,0 +1,167 @@
+"""Local lexical (BM25) index over uploaded documents.
+
+Documents are chunked once when they are uploaded so that each question only
+sends the most relevant passages to the model instead of the whole file.
+The index only keeps chunk offsets; passage text is read back from the
+document when a chunk is actually selected.
+"""
+import heapq
+import math
+import os
+import pickle
+import re
+import sys
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+# Page separator used in extracted text
+PAGE_BREAK = "\f"
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+WORD_PATTERN = re.compile(r"\S+")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i in is it me my of on or
+our should that the their this to was what when where which who why will with
+you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens with stopwords removed"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def chunk_spans(text: str, chunk_words: int = 200, overlap_words: int = 40) -> List[Tuple[int, int]]:
+    """Character spans of overlapping word windows over one page of text"""
+    words = [match.span() for match in WORD_PATTERN.finditer(text)]
+    spans = []
+    step = max(1, chunk_words - overlap_words)
+
+    for start in range(0, len(words), step):
+        end = min(start + chunk_words, len(words))
+        spans.append((words[start][0], words[end - 1][1]))
+        if end >= len(words):
+            break
+
+    return spans
+
+
+class DocumentIndex:
+    """BM25 index over the chunks of a single document.
+
+    source is any object with page_count, paged, iter_pages() and
+    read_page(page_number), e.g. a StoredDocument handle.
+    """
+
+    def __init__(self, source: Any, k1: float = 1.5, b: float = 0.75):
+        self.source = source
+        self.k1 = k1
+        self.b = b
+
+        # Chunk i covers source page chunk_pages[i], characters chunk_starts[i]:chunk_ends[i]
+        self.chunk_pages = array("i")
+        self.chunk_starts = array("i")
+        self.chunk_ends = array("i")
+        self.lengths = array("i")
+        # term -> [chunk id, term frequency, chunk id, term frequency, ...]
+        self.postings: Dict[str, array] = {}
+
+        for page_number, page in enumerate(source.iter_pages(), start=1):
+            for start, end in chunk_spans(page):
+                chunk_id = len(self.chunk_pages)
+                self.chunk_pages.append(page_number)
+                self.chunk_starts.append(start)
+                self.chunk_ends.append(end)
+
+                counts = Counter(tokenize(page[start:end]))
+                self.lengths.append(sum(counts.values()))
+                for term, frequency in counts.items():
+                    postings = self.postings.get(term)
+                    if postings is None:
+                        postings = self.postings[term] = array("i")
+                    postings.extend((chunk_id, frequency))
+
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.memory_bytes = self._estimate_memory()
+
+    def save(self, path: str) -> None:
+        """Write the index structures (not the source) to path"""
+        state = dict(self.__dict__)
+        del state["source"]
+        partial_path = f"{path}.partial"
+        with open(partial_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path: str, source: Any) -> "DocumentIndex":
+        """Index written by save(), reattached to its source document"""
+        index = cls.__new__(cls)
+        with open(path, "rb") as f:
+            index.__dict__.update(pickle.load(f))
+        index.source = source
+        return index
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.chunk_pages)
+
+    def chunk(self, chunk_id: int, page_text: str = None) -> Dict[str, Any]:
+        """Chunk metadata and text, read from the source document"""
+        page_number = self.chunk_pages[chunk_id]
+        if page_text is None:
+            page_text = self.source.read_page(page_number)
+        text = page_text[self.chunk_starts[chunk_id]:self.chunk_ends[chunk_id]]
+        return {"id": chunk_id, "page": page_number, "text": " ".join(text.split())}
+
+    def search(self, query: str, top_k: int = 8) -> List[Dict[str, Any]]:
+        """Return the top_k chunks for the query, best first"""
+        chunk_count = self.chunk_count
+        scores: Dict[int, float] = {}
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            document_frequency = len(postings) // 2
+            idf = math.log(1 + (chunk_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            for i in range(0, len(postings), 2):
+                chunk_id, frequency = postings[i], postings[i + 1]
+                length_norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / self.average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + length_norm)
+
+        # No lexical overlap at all: fall back to the start of the document
+        if not scores:
+            ranked = [(chunk_id, 0.0) for chunk_id in range(min(top_k, chunk_count))]
+        else:
+            ranked = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+        # Read each page at most once, even when several of its chunks were selected
+        pages: Dict[int, str] = {}
+        results = []
+        for chunk_id, score in ranked:
+            page_number = self.chunk_pages[chunk_id]
+            if page_number not in pages:
+                pages[page_number] = self.source.read_page(page_number)
+            results.append(dict(self.chunk(chunk_id, pages[page_number]), score=score))
+        return results
+
+    def relevant_passages(self, query: str, top_k: int = 8) -> str:
+        """Top passages formatted for a prompt, in document order with page references"""
+        passages = sorted(self.search(query, top_k), key=lambda chunk: chunk["id"])
+        formatted = []
+        for chunk in passages:
+            reference = f"p. {chunk['page']}" if self.source.paged else f"passage {chunk['id'] + 1}"
+            formatted.append(f"[{reference}] {chunk['text']}")
+        return "\n\n".join(formatted)
+
+    def _estimate_memory(self) -> int:
+        """Approximate bytes held by the index structures (not the source text)"""
+        total = sys.getsizeof(self.postings)
+        for term, postings in self.postings.items():
+            total += sys.getsizeof(term) + sys.getsizeof(postings)
+        for column in (self.chunk_pages, self.chunk_starts, self.chunk_ends, self.lengths):
+            total += sys.getsizeof(column)
+        return total
@@ -0,0 +1,187 @@
+"""On-disk store for extracted document text.
+
+Uploads are streamed to disk and extracted page by page into a UTF-8 text
+file named after the SHA-256 of the uploaded bytes. Sessions only keep a
+small StoredDocument handle (size and page offsets) and read page text back
+lazily, so a large binder never has to sit in memory as one string.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Iterator, List, Optional
+
+from extraction import PAGED_TYPES, iter_pages
+
+STORE_DIR = os.getenv("DOCUMENT_STORE_DIR", os.path.join(tempfile.gettempdir(), "alignment-helper", "documents"))
+
+# Stored files not read for this long are removed by prune()
+STORE_TTL_SECONDS = float(os.getenv("DOCUMENT_STORE_TTL_HOURS", "24")) * 3600
+
+# Reads through a handle mark its document as in use at most this often
+TOUCH_INTERVAL_SECONDS = 60
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class StoredDocument:
+    """Handle to extracted text on disk"""
+    file_hash: str
+    path: str
+    size: int
+    paged: bool
+    # Byte offset where each page starts, followed by the end of the file
+    page_offsets: List[int] = field(default_factory=list)
+    touched_at: float = field(default=0.0, compare=False, repr=False)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_offsets) - 1
+
+    @property
+    def byte_size(self) -> int:
+        return self.page_offsets[-1] if self.page_offsets else 0
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.splitext(self.path)[0] + ".json"
+
+    def touch(self) -> None:
+        """Keep the document from being pruned while a session still reads it"""
+        now = time.time()
+        if now - self.touched_at < TOUCH_INTERVAL_SECONDS:
+            return
+        try:
+            os.utime(self.meta_path, (now, now))
+        except FileNotFoundError:
+            pass
+        self.touched_at = now
+
+    def read_page(self, page_number: int) -> str:
+        self.touch()
+        start, end = self.page_offsets[page_number - 1], self.page_offsets[page_number]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start).decode("utf-8")
+
+    def iter_pages(self) -> Iterator[str]:
+        self.touch()
+        with open(self.path, "rb") as f:
+            for start, end in zip(self.page_offsets, self.page_offsets[1:]):
+                f.seek(start)
+                yield f.read(end - start).decode("utf-8")
+
+    def preview(self, chars: int = 500) -> str:
+        self.touch()
+        with open(self.path, "rb") as f:
+            # Up to 4 bytes per character in UTF-8
+            return f.read(chars * 4).decode("utf-8", errors="ignore")[:chars]
+
+
+class DocumentStore:
+    """Content-addressed directory of extracted documents"""
+
+    def __init__(self, root: str = STORE_DIR, ttl_seconds: float = STORE_TTL_SECONDS):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, file_hash: str) -> Optional[StoredDocument]:
+        meta_path = os.path.join(self.root, f"{file_hash}.json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        document = StoredDocument(path=os.path.join(self.root, f"{file_hash}.txt"), **meta)
+        if not os.path.exists(document.path):
+            return None
+        # Reading a document keeps it from being pruned
+        document.touch()
+        return document
+
+    def ingest(self, upload: Any, file_type: str) -> StoredDocument:
+        """Store an uploaded file object, reusing an earlier extraction of the same bytes"""
+        token = uuid.uuid4().hex
+        source_path = os.path.join(self.root, f".{token}.upload")
+        try:
+            # Copy the upload to disk in blocks, hashing as we go
+            digest = hashlib.sha256()
+            upload.seek(0)
+            with open(source_path, "wb") as f:
+                for block in iter(lambda: upload.read(COPY_BLOCK_SIZE), b""):
+                    digest.update(block)
+                    f.write(block)
+            upload.seek(0)
+            file_hash = digest.hexdigest()
+
+            existing = self.get(file_hash)
+            if existing is not None:
+                return existing
+            return self._extract(source_path, file_hash, file_type, token)
+        finally:
+            if os.path.exists(source_path):
+                os.remove(source_path)
+
+    def ingest_path(self, path: str, file_type: str) -> StoredDocument:
+        """Store a file already on disk"""
+        with open(path, "rb") as f:
+            return self.ingest(f, file_type)
+
+    def delete(self, file_hash: str) -> None:
+        """Remove a stored document; handles still pointing at it stop working"""
+        for extension in (".json", ".txt"):
+            try:
+                os.remove(os.path.join(self.root, f"{file_hash}{extension}"))
+            except FileNotFoundError:
+                pass
+
+    def prune(self) -> int:
+        """Remove documents that have not been read for ttl_seconds, returning how many.
+
+        Sessions read their documents (the sidebar preview among them) on every
+        rerun, so only documents of sessions that have gone idle are removed.
+        """
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(meta_path) >= cutoff:
+                    continue
+                os.remove(meta_path)
+                os.remove(meta_path[:-len(".json")] + ".txt")
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def _extract(self, source_path: str, file_hash: str, file_type: str, token: str) -> StoredDocument:
+        text_path = os.path.join(self.root, f"{file_hash}.txt")
+        partial_path = os.path.join(self.root, f".{token}.txt")
+        page_offsets = [0]
+        size = 0
+        try:
+            with open(partial_path, "wb") as out:
+                for page in iter_pages(source_path, file_type):
+                    encoded = page.encode("utf-8")
+                    out.write(encoded)
+                    size += len(page)
+                    page_offsets.append(page_offsets[-1] + len(encoded))
+            os.replace(partial_path, text_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+        meta = {"file_hash": file_hash, "size": size, "paged": file_type in PAGED_TYPES, "page_offsets": page_offsets}
+        meta_path = os.path.join(self.root, f"{file_hash}.json")
+        with open(meta_path + f".{token}", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + f".{token}", meta_path)
+        return StoredDocument(path=text_path, **meta)
@@ -0,0 +1,156 @@
+"""Text extraction for uploaded documents.
+
+Extraction is page by page: the iter_*_pages generators never build the
+whole document text, so callers can spill pages to disk as they arrive.
+Everything here raises on failure and works outside Streamlit. pypdf and
+python-docx are imported on first use, so importing this module is cheap.
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Iterator, List
+
+from document_index import PAGE_BREAK
+
+PDF_TYPE = "application/pdf"
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+TXT_TYPE = "text/plain"
+
+# Only PDFs carry real page numbers; other types are split into blocks
+PAGED_TYPES = {PDF_TYPE}
+
+FILE_TYPES_BY_EXTENSION = {".pdf": PDF_TYPE, ".docx": DOCX_TYPE, ".txt": TXT_TYPE}
+
+# PDFs with at least this many pages are extracted by a process pool
+PARALLEL_PAGE_THRESHOLD = int(os.getenv("PARALLEL_PAGE_THRESHOLD", "64"))
+PAGES_PER_TASK = 32
+MAX_EXTRACTION_WORKERS = int(os.getenv("MAX_EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+DOCX_PARAGRAPHS_PER_BLOCK = 50
+TXT_CHARS_PER_BLOCK = 16 * 1024
+
+# PdfReader opened once per worker process
+_worker_reader = None
+
+
+def file_type_for_path(path: str) -> str:
+    """MIME type of a document on disk, from its extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FILE_TYPES_BY_EXTENSION:
+        raise ValueError(f"Unsupported file type: {extension or path}")
+    return FILE_TYPES_BY_EXTENSION[extension]
+
+
+def _open(source: Any) -> Any:
+    """Raw bytes are wrapped in a stream; paths and file objects are used as-is"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def _init_worker(source: Any) -> None:
+    import pypdf
+
+    global _worker_reader
+    _worker_reader = pypdf.PdfReader(_open(source))
+
+
+def _extract_page_range(start: int, stop: int) -> List[str]:
+    return [_worker_reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def iter_pdf_pages(source: Any) -> Iterator[str]:
+    """Text of every PDF page, in order. source is a path, bytes or a file object."""
+    import pypdf
+
+    reader = pypdf.PdfReader(_open(source))
+    page_count = len(reader.pages)
+    extracted = 0
+
+    # Large PDFs: each worker parses the file once, then extracts ranges of pages.
+    # Spawned (not forked) workers, since the Streamlit server is multithreaded.
+    # Workers need a picklable source, so open file objects are extracted serially.
+    parallel = (
+        page_count >= PARALLEL_PAGE_THRESHOLD
+        and MAX_EXTRACTION_WORKERS >= 2
+        and isinstance(source, (str, bytes))
+    )
+    if parallel:
+        starts = list(range(0, page_count, PAGES_PER_TASK))
+        stops = [min(start + PAGES_PER_TASK, page_count) for start in starts]
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(MAX_EXTRACTION_WORKERS, len(starts)),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(source,)
+            ) as pool:
+                for page_range in pool.map(_extract_page_range, starts, stops):
+                    for text in page_range:
+                        extracted += 1
+                        yield text
+        except (BrokenProcessPool, OSError):
+            # Worker processes unavailable: finish in this process instead
+            pass
+
+    for i in range(extracted, page_count):
+        yield reader.pages[i].extract_text()
+
+
+def iter_docx_pages(source: Any) -> Iterator[str]:
+    """DOCX text in blocks of paragraphs"""
+    import docx
+
+    document = docx.Document(_open(source))
+    paragraphs = document.paragraphs
+    for start in range(0, len(paragraphs), DOCX_PARAGRAPHS_PER_BLOCK):
+        yield "".join(paragraph.text + "\n" for paragraph in paragraphs[start:start + DOCX_PARAGRAPHS_PER_BLOCK])
+
+
+def iter_txt_pages(source: Any) -> Iterator[str]:
+    """UTF-8 text in blocks of whole lines"""
+    owned = isinstance(source, str)
+    reader = io.TextIOWrapper(open(source, "rb") if owned else _open(source), encoding="utf-8")
+    block = []
+    block_size = 0
+    try:
+        for line in reader:
+            block.append(line)
+            block_size += len(line)
+            if block_size >= TXT_CHARS_PER_BLOCK:
+                yield "".join(block)
+                block = []
+                block_size = 0
+        if block:
+            yield "".join(block)
+    finally:
+        # Never close a stream that belongs to the caller
+        if owned:
+            reader.close()
+        else:
+            reader.detach()
+
+
+PAGE_ITERATORS = {
+    PDF_TYPE: iter_pdf_pages,
+    DOCX_TYPE: iter_docx_pages,
+    TXT_TYPE: iter_txt_pages
+}
+
+
+def iter_pages(source: Any, file_type: str) -> Iterator[str]:
+    """Page (or block) generator for a supported file type, raising ValueError otherwise"""
+    page_iterator = PAGE_ITERATORS.get(file_type)
+    if page_iterator is None:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    return page_iterator(source)
+
+
+def extract_text_from_pdf(data: bytes) -> str:
+    """Extract text from PDF bytes, pages separated by PAGE_BREAK"""
+    return PAGE_BREAK.join(page + "\n" for page in iter_pdf_pages(data))
+
+
+def extract_text_from_docx(data: bytes) -> str:
+    """Extract text from DOCX bytes"""
+    return "".join(iter_docx_pages(data))
@@ -0,0 +1,182 @@
+"""Process-wide limits on calls to Bedrock.
+
+Every session shares one governor per Bedrock client. It caps how many calls
+are in flight, spaces calls out to a requests-per-minute quota with a token
+bucket, and keeps queue depth, wait time and throttling metrics. Retries are
+left to botocore's adaptive retry mode (see clients.py), which backs off with
+jitter and slows the client down while Bedrock is throttling.
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+# Error codes Bedrock returns when a quota is exceeded
+THROTTLING_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+
+# Recent wait times kept for the p50/p95 metrics
+WAIT_SAMPLES = 1000
+
+# Client methods that are limited; everything else is passed straight through
+GOVERNED_METHODS = {"converse", "converse_stream", "invoke_model", "retrieve"}
+
+# Governors created in this process by name, for load displays
+GOVERNORS: Dict[str, "Governor"] = {}
+
+
+class TokenBucket:
+    """Allows rate_per_minute acquisitions per minute, with bursts of up to capacity"""
+
+    def __init__(self, rate_per_minute: float, capacity: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Governor:
+    """Concurrency limit plus optional requests-per-minute limit, with metrics"""
+
+    def __init__(self, name: str, max_concurrency: int = 8, requests_per_minute: float = 0, burst: int = 0):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._bucket = TokenBucket(requests_per_minute, burst or self.max_concurrency) if requests_per_minute > 0 else None
+        self.requests_per_minute = requests_per_minute
+        self._lock = threading.Lock()
+        self._waits: deque = deque(maxlen=WAIT_SAMPLES)
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.throttled_attempts = 0
+        GOVERNORS[name] = self
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, default_concurrency: int) -> "Governor":
+        """Governor configured by the <prefix>_MAX_CONCURRENCY and <prefix>_REQUESTS_PER_MINUTE variables"""
+        return cls(
+            name,
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(default_concurrency))),
+            requests_per_minute=float(os.getenv(f"{prefix}_REQUESTS_PER_MINUTE", "0"))
+        )
+
+    def acquire(self) -> None:
+        """Wait for a free slot (and a rate token), recording how long that took"""
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+            self._waits.append(time.monotonic() - started)
+
+    def release(self, failed: bool = False) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.failures += 1
+        self._slots.release()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.acquire()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.release(failed)
+
+    def record_attempt(self, response: Any = None, **kwargs) -> None:
+        """botocore needs-retry hook: counts throttled attempts, never decides on retries itself"""
+        if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_CODES:
+            with self._lock:
+                self.throttled_attempts += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            metrics = {
+                "queue_depth": self.waiting,
+                "max_queue_depth": self.max_waiting,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "requests_per_minute": self.requests_per_minute or None,
+                "requests": self.requests,
+                "failures": self.failures,
+                "throttled_attempts": self.throttled_attempts
+            }
+        metrics["wait_p50_ms"] = round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0
+        metrics["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0
+        return metrics
+
+
+class GovernedClient:
+    """Wraps a Bedrock client so that its calls go through a governor"""
+
+    def __init__(self, client: Any, governor: Governor):
+        self.client = client
+        self.governor = governor
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is not None:
+            events.register("needs-retry", governor.record_attempt)
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.client, name)
+        if name not in GOVERNED_METHODS:
+            return attribute
+        if name == "converse_stream":
+            return self._converse_stream
+
+        def governed(*args, **kwargs):
+            with self.governor.slot():
+                return attribute(*args, **kwargs)
+        return governed
+
+    def _converse_stream(self, *args, **kwargs) -> Dict[str, Any]:
+        # The slot is held until the stream has been read to the end (or abandoned)
+        self.governor.acquire()
+        try:
+            response = self.client.converse_stream(*args, **kwargs)
+        except Exception:
+            self.governor.release(failed=True)
+            raise
+        response["stream"] = self._release_after(response["stream"])
+        return response
+
+    def _release_after(self, stream: Any) -> Iterator[Dict[str, Any]]:
+        failed = False
+        try:
+            yield from stream
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.governor.release(failed)
@@ -0,0 +1,235 @@
+"""Background pipeline jobs.
+
+A chat question runs as a job on a pool of worker threads in the app process,
+not inside the Streamlit script run that asked it. A long analysis therefore
+survives reruns, closed tabs and dropped connections, and one process can run
+many analyses at once. Each job records its progress messages and the PATH 1
+and PATH 2 results as they finish. The page polls the job by its ID and
+renders whatever has arrived so far.
+
+Jobs are kept in memory and, when JOB_STORE_PATH is set, in a SQLite file, so
+results can still be collected after the server restarts. Jobs that were
+still running when the process stopped are marked as failed. A job leaves
+memory once a session has collected its result, or, with a SQLite file,
+shortly after it finishes; it can still be read from the file until it expires.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from pipeline import PipelineListener
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+# How often the page checks a running job for progress
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+# Streamed text reaches the SQLite store at most this often per job; every other change is written at once
+PERSIST_INTERVAL_SECONDS = 1.0
+
+# With a SQLite store, finished jobs stay in memory this long and are read from the file afterwards
+PERSISTED_JOB_MEMORY_SECONDS = 60
+
+# Expired jobs are looked for at most this often
+EXPIRE_INTERVAL_SECONDS = 10
+
+# Job fields that only live in memory (the Trace object of the run)
+MEMORY_ONLY_FIELDS = ("trace",)
+
+
+class JobListener(PipelineListener):
+    """Records the progress and partial results of a pipeline run into its job"""
+
+    def __init__(self, jobs: "JobQueue", job_id: str):
+        self._jobs = jobs
+        self._job_id = job_id
+
+    def status(self, level: str, message: str) -> None:
+        self._jobs._update(self._job_id, lambda job: job["events"].append([level, message]))
+
+    def retrieval_complete(self, retrieved_docs: List[Dict[str, Any]]) -> None:
+        self._jobs._update(self._job_id, lambda job: job.update(retrieved=retrieved_docs))
+
+    def document_started(self, name: str) -> None:
+        self._jobs._update(self._job_id, lambda job: job["documents"].setdefault(name, ""))
+
+    def document_text(self, name: str, text: str) -> None:
+        def append(job):
+            job["documents"][name] = job["documents"].get(name, "") + text
+        self._jobs._update(self._job_id, append, persist=False)
+
+    def synthesis_text(self, text: str) -> None:
+        def append(job):
+            job["synthesis"] += text
+        self._jobs._update(self._job_id, append, persist=False)
+
+    def document_complete(self, name: str, analysis: str) -> None:
+        def complete(job):
+            job["documents"][name] = analysis
+            job["completed"].append(name)
+        self._jobs._update(self._job_id, complete)
+
+    def synthesis_complete(self, text: str) -> None:
+        self._jobs._update(self._job_id, lambda job: job.update(synthesis=text))
+
+
+class JobQueue:
+    """Runs pipeline jobs on worker threads and keeps their progress and results.
+
+    Jobs live in memory and, when db_path is given, in a SQLite file. Finished
+    jobs leave memory when collected, after PERSISTED_JOB_MEMORY_SECONDS when
+    the file has them, and in any case ttl_seconds after they finish.
+    """
+
+    def __init__(self, workers: int = 8, ttl_seconds: float = 24 * 3600, db_path: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline-job")
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._persisted_at: Dict[str, float] = {}
+        self._expired_at = 0.0
+        self._lock = threading.Lock()
+        self._db = None
+
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            # Jobs of an earlier process that had not finished never will
+            now = time.time()
+            for job_id, record in self._db.execute(
+                "SELECT id, record FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall():
+                job = json.loads(record)
+                job.update(status=FAILED, error="Interrupted by a server restart", finished_at=now)
+                self._db.execute("UPDATE jobs SET status = ?, record = ?, updated_at = ? WHERE id = ?",
+                                 (FAILED, json.dumps(job), now, job_id))
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        """Queue configured by the JOB_* environment variables"""
+        return cls(
+            workers=int(os.getenv("JOB_WORKERS", "8")),
+            ttl_seconds=float(os.getenv("JOB_TTL_HOURS", "24")) * 3600,
+            db_path=os.getenv("JOB_STORE_PATH") or None
+        )
+
+    def submit(self, question: str, run: Callable[[JobListener], Dict[str, Any]]) -> str:
+        """Queue run(listener) and return the job ID.
+
+        run reports progress through the listener and returns the fields of the
+        finished job (response, log and so on); an exception fails the job.
+        """
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": QUEUED,
+            "question": question,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "events": [],
+            "documents": {},
+            "completed": [],
+            "retrieved": [],
+            "synthesis": "",
+            "response": None,
+            "error": None
+        }
+        with self._lock:
+            self._expire(now)
+            self._jobs[job["id"]] = job
+            self._persist(job, now)
+        self._executor.submit(self._run, job["id"], run)
+        return job["id"]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Snapshot of a job, or None when it is unknown or has expired"""
+        with self._lock:
+            self._expire(time.time())
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return {**job, "events": list(job["events"]), "documents": dict(job["documents"]),
+                        "completed": list(job["completed"])}
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        if job["finished_at"] is not None and time.time() - job["finished_at"] >= self.ttl_seconds:
+            return None
+        return job
+
+    def collect(self, job_id: str) -> None:
+        """Forget a job whose result a session has taken; with a SQLite store it can still be read from there"""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._persisted_at.pop(job_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Jobs of this process still in memory, by status"""
+        with self._lock:
+            self._expire(time.time())
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return counts
+
+    def _run(self, job_id: str, run: Callable[[JobListener], Dict[str, Any]]) -> None:
+        self._update(job_id, lambda job: job.update(status=RUNNING, started_at=time.time()))
+        try:
+            result = run(JobListener(self, job_id))
+        except Exception as e:
+            error = str(e)
+            self._update(job_id, lambda job: job.update(status=FAILED, error=error, finished_at=time.time()))
+        else:
+            self._update(job_id, lambda job: job.update(result, status=DONE, finished_at=time.time()))
+
+    def _update(self, job_id: str, change: Callable[[Dict[str, Any]], Any], persist: bool = True) -> None:
+        now = time.time()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            change(job)
+            if persist or now - self._persisted_at.get(job_id, 0) >= PERSIST_INTERVAL_SECONDS:
+                self._persist(job, now)
+
+    def _persist(self, job: Dict[str, Any], now: float) -> None:
+        if self._db is None:
+            return
+        record = {key: value for key, value in job.items() if key not in MEMORY_ONLY_FIELDS}
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (id, status, record, updated_at) VALUES (?, ?, ?, ?)",
+            (job["id"], job["status"], json.dumps(record, default=str), now)
+        )
+        self._db.commit()
+        self._persisted_at[job["id"]] = now
+
+    def _expire(self, now: float) -> None:
+        """Drop finished jobs from memory and expired ones from the store; call with the lock held"""
+        if now - self._expired_at < EXPIRE_INTERVAL_SECONDS:
+            return
+        self._expired_at = now
+        cutoff = now - self.ttl_seconds
+        memory_cutoff = now - PERSISTED_JOB_MEMORY_SECONDS if self._db is not None else cutoff
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] <= memory_cutoff]:
+            del self._jobs[job_id]
+            self._persisted_at.pop(job_id, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at <= ?", (DONE, FAILED, cutoff))
+            self._db.commit()
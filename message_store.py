@@ -0,0 +1,132 @@
+"""Bounded chat history for a session.
+
+Each message is stored once, with its pipeline log and knowledge base debug
+metadata kept in separate fields so they are only rendered on request. Only
+the most recent messages stay in memory; older ones are compressed and
+spilled to a per-session file and read back a page at a time.
+"""
+import json
+import os
+import tempfile
+import time
+import uuid
+import zlib
+from array import array
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", os.path.join(tempfile.gettempdir(), "alignment-helper", "history"))
+
+# Messages kept in memory per session before older ones are spilled to disk
+MEMORY_MESSAGES = int(os.getenv("CHAT_HISTORY_MEMORY_MESSAGES", "20"))
+
+# Spill files not written or read for this long are removed by prune_history()
+HISTORY_TTL_SECONDS = float(os.getenv("CHAT_HISTORY_TTL_HOURS", "24")) * 3600
+
+
+def prune_history(root: str = HISTORY_DIR, ttl_seconds: float = HISTORY_TTL_SECONDS) -> int:
+    """Remove spill files of sessions that have gone away, returning how many"""
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - ttl_seconds
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if name.endswith(".history") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class MessageStore:
+    """Chat messages with sequential ids; the oldest are spilled to disk past memory_messages"""
+
+    def __init__(self, memory_messages: int = MEMORY_MESSAGES, root: str = HISTORY_DIR):
+        self.memory_messages = max(1, memory_messages)
+        self.root = root
+        self.path = os.path.join(root, f"{uuid.uuid4().hex}.history")
+        self.executions = 0
+        self._recent: deque = deque()
+        # Byte offset of each spilled message, followed by the end of the file
+        self._offsets = array("q", [0])
+
+    def __len__(self) -> int:
+        return self.spilled_count + len(self._recent)
+
+    @property
+    def spilled_count(self) -> int:
+        return len(self._offsets) - 1
+
+    def append(self, role: str, content: str, debug: Optional[str] = None,
+               log: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        message = {"id": len(self), "role": role, "content": content}
+        if debug:
+            message["debug"] = debug
+        if log is not None:
+            self.executions += 1
+            message["log"] = dict(log, execution=self.executions)
+        self._recent.append(message)
+        while len(self._recent) > self.memory_messages:
+            self._spill(self._recent.popleft())
+        return message
+
+    def page(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        """Messages with ids in [start, stop), reading spilled ones back from disk"""
+        start, stop = max(0, start), min(stop, len(self))
+        messages = []
+        if self.spilled_count:
+            self._touch()
+        if start < self.spilled_count:
+            messages.extend(self._read_spilled(start, min(stop, self.spilled_count)))
+        first_recent = max(start, self.spilled_count) - self.spilled_count
+        last_recent = stop - self.spilled_count
+        messages.extend(list(self._recent)[first_recent:last_recent])
+        return messages
+
+    def recent_logs(self, count: int) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """(log, message) pairs of the newest in-memory assistant turns, newest first"""
+        logs = []
+        for message in reversed(self._recent):
+            if "log" in message:
+                logs.append((message["log"], message))
+                if len(logs) == count:
+                    break
+        return logs
+
+    def clear(self) -> None:
+        self._recent.clear()
+        self._offsets = array("q", [0])
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _touch(self) -> None:
+        """Keep the spill file of a session that still renders its history from being pruned"""
+        try:
+            now = time.time()
+            os.utime(self.path, (now, now))
+        except FileNotFoundError:
+            pass
+
+    def _spill(self, message: Dict[str, Any]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        data = zlib.compress(json.dumps(message).encode("utf-8"))
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def _read_spilled(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, "rb") as f:
+                messages = []
+                f.seek(self._offsets[start])
+                for i in range(start, stop):
+                    data = f.read(self._offsets[i + 1] - self._offsets[i])
+                    messages.append(json.loads(zlib.decompress(data)))
+                return messages
+        except FileNotFoundError:
+            # Pruned while the session sat idle past CHAT_HISTORY_TTL_HOURS
+            return [{"id": i, "role": "assistant", "content": "_(This message expired while the session was idle.)_"}
+                    for i in range(start, stop)]
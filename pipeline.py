@@ -0,0 +1,781 @@
+"""Two-path analysis pipeline, independent of the UI.
+
+PATH 1 analyzes the uploaded state requirements documents and PATH 2
+retrieves matches from the Bedrock knowledge base and synthesizes feedback.
+Progress is reported through a PipelineListener, so the same pipeline backs
+the Streamlit app and the headless batch_eval.py CLI.
+"""
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from batching import BATCH_DOCUMENT_TOKENS, SectionRouter, plan_batches, section_heading, split_analyses
+from caching import AnalysisCache, RetrievalCache
+from reranking import RETRIEVAL_CANDIDATES, build_metadata_filter, filter_selections, select_matches
+from sections import (SINGLE_SHOT_TOKEN_LIMIT, SECTION_TOKENS, estimate_document_tokens, estimate_tokens, format_pages, split_sections,
+                      text_hash)
+from telemetry import CACHE_OUTCOME, Span, Trace
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+
+# Upper bound on concurrent Bedrock calls made by a single pipeline run
+MAX_PARALLEL_REQUESTS = int(os.getenv('MAX_PARALLEL_REQUESTS', '4'))
+
+# Number of passages from each document sent with a question
+PASSAGES_PER_DOCUMENT = int(os.getenv('PASSAGES_PER_DOCUMENT', '8'))
+
+# Concurrent section analyses per document in map-reduce mode
+MAP_REDUCE_PARALLELISM = int(os.getenv('MAP_REDUCE_PARALLELISM', '4'))
+
+# PATH 1 analysis modes: the passages most relevant to the question, or the whole document
+PASSAGES_MODE = "passages"
+FULL_DOCUMENT_MODE = "full"
+
+NO_RELEVANT_REQUIREMENTS = "NO RELEVANT REQUIREMENTS"
+
+# Bedrock prompt caching: stable prompt prefixes (document text, instructions,
+# knowledge base matches) are placed before a cache checkpoint
+PROMPT_CACHING = os.getenv('PROMPT_CACHING', 'true').lower() not in ('0', 'false', 'no')
+
+# Prefixes shorter than this are sent without a checkpoint (the model's cacheable minimum)
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv('PROMPT_CACHE_MIN_TOKENS', '1024'))
+
+# Cleared the first time Bedrock rejects a cache checkpoint for this model
+_prompt_caching_supported = True
+
+class PipelineListener:
+  """Receives pipeline progress; the default implementation ignores everything.
+
+  All methods are called on the thread that called run_pipeline, never on a
+  worker thread, so UI code can be used directly inside them.
+  """
+
+  def status(self, level: str, message: str) -> None:
+    """Stage updates; level is one of info, success, warning or error"""
+
+  def retrieval_complete(self, retrieved_docs: List[Dict[str, Any]]) -> None:
+    """Raw knowledge base results, before they are turned into citations"""
+
+  def document_started(self, name: str) -> None:
+    """Streaming mode: the analysis of a document is about to produce text"""
+
+  def document_text(self, name: str, text: str) -> None:
+    """Streaming mode: more analysis text for a document"""
+
+  def synthesis_started(self) -> None:
+    """Streaming mode: the knowledge base synthesis is about to produce text"""
+
+  def synthesis_text(self, text: str) -> None:
+    """Streaming mode: more knowledge base synthesis text"""
+
+  def document_complete(self, name: str, analysis: str) -> None:
+    """The finished PATH 1 analysis of a document, cached or new, in either mode"""
+
+  def synthesis_complete(self, text: str) -> None:
+    """The finished PATH 2 knowledge base synthesis, in either mode"""
+
+def build_filter_context(context: Optional[Dict[str, Any]]) -> str:
+  """Sidebar filter selections as a single prompt line"""
+  filter_context_parts = []
+  if context:
+    if context.get("states") and len(context["states"]) > 0:
+      states_str = ", ".join(context["states"])
+      filter_context_parts.append(f"States: {states_str}")
+    if context.get("grade") and context["grade"] != "All Grades":
+      filter_context_parts.append(f"Grade Level: {context['grade']}")
+    if context.get("subject") and context["subject"] != "All Subjects":
+      filter_context_parts.append(f"Subject: {context['subject']}")
+  return ', '.join(filter_context_parts) if filter_context_parts else 'No specific filters'
+
+def stream_converse(bedrock_client: Any, span: Optional[Span] = None, **kwargs) -> Iterator[str]:
+  """Yield text deltas from a converse_stream call, recording usage on span"""
+  response = bedrock_client.converse_stream(**kwargs)
+  for event in response['stream']:
+    delta = event.get('contentBlockDelta', {}).get('delta', {})
+    if 'text' in delta:
+      yield delta['text']
+    elif 'metadata' in event and span is not None:
+      span.record_usage(event['metadata'])
+
+def build_prompt_messages(stable: str, question: str, cache: bool = True) -> List[Dict[str, Any]]:
+  """A user message with the stable prefix first and the question after a cache checkpoint"""
+  if cache and PROMPT_CACHING and _prompt_caching_supported and estimate_tokens(stable) >= PROMPT_CACHE_MIN_TOKENS:
+    content = [{"text": stable}, {"cachePoint": {"type": "default"}}, {"text": question}]
+  else:
+    content = [{"text": f"{stable}\n\n{question}"}]
+  return [{"role": "user", "content": content}]
+
+def _without_cache_points(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  """Same messages with checkpoints removed and the text blocks merged"""
+  return [
+    {"role": message["role"], "content": [{"text": "\n\n".join(block["text"] for block in message["content"] if "text" in block)}]}
+    for message in messages
+  ]
+
+def converse_text(bedrock_client: Any, messages: List[Dict[str, Any]], max_tokens: int,
+                  on_text: Optional[Callable[[str], None]] = None, span: Optional[Span] = None) -> str:
+  """Run a converse (or, with on_text, converse_stream) call and return its text.
+
+  Models that do not support cache checkpoints reject them with a
+  ValidationException about the cachePoint; the call is then repeated without
+  them and caching is turned off for the rest of the process. Any other
+  validation error (an oversized prompt, say) is raised as usual.
+  """
+  global _prompt_caching_supported
+  try:
+    # Streaming mode: forward each delta as it arrives and return the full text
+    if on_text is not None:
+      parts = []
+      for text in stream_converse(bedrock_client, span, modelId=MODEL_ID, messages=messages, inferenceConfig={"maxTokens": max_tokens}):
+        parts.append(text)
+        on_text(text)
+      return "".join(parts)
+
+    response = bedrock_client.converse(
+      modelId=MODEL_ID,
+      messages=messages,
+      inferenceConfig={"maxTokens": max_tokens}
+    )
+  except Exception as e:
+    error = getattr(e, 'response', {}).get('Error', {})
+    has_cache_point = any("cachePoint" in block for message in messages for block in message["content"])
+    about_caching = "cache" in error.get('Message', str(e)).lower()
+    if error.get('Code') != 'ValidationException' or not has_cache_point or not about_caching:
+      raise
+    _prompt_caching_supported = False
+    return converse_text(bedrock_client, _without_cache_points(messages), max_tokens, on_text, span)
+
+  if span is not None:
+    span.record_usage(response)
+  return response['output']['message']['content'][0]['text']
+
+def analyze_state_document(bedrock_client: Any, name: str, content: str, user_message: str, filter_context: str,
+                           on_text: Optional[Callable[[str], None]] = None, span: Optional[Span] = None,
+                           content_label: str = "RELEVANT PASSAGES (with page references)", cache_prompt: bool = False) -> str:
+  """PATH 1: analyze a single state requirements document
+
+  cache_prompt puts the document and instructions before a cache checkpoint;
+  use it when the same content is sent with other questions (whole documents).
+  """
+  # Everything that does not depend on the question comes first
+  state_prompt = f"""Analyze the following state requirements document and provide feedback on how it relates to the user's question.
+
+DOCUMENT: {name}
+{content_label}:
+{content}
+
+Please provide:
+1. Key requirements from the document
+2. How these requirements relate to the user's question
+3. Specific feedback on alignment or gaps
+4. Recommendations based on the state requirements
+
+Focus on being specific and citing exact requirements from the document, including their page references."""
+
+  question_prompt = f"""USER QUESTION: {user_message}
+FILTER CONTEXT: {filter_context}"""
+
+  state_messages = build_prompt_messages(state_prompt, question_prompt, cache_prompt)
+  return converse_text(bedrock_client, state_messages, 1500, on_text, span)
+
+def analyze_document_batch(bedrock_client: Any, documents: List[Tuple[str, str, str]], user_message: str,
+                           filter_context: str, on_text: Optional[Callable[[str, str], None]] = None,
+                           span: Optional[Span] = None, cache_prompt: bool = False) -> Dict[str, str]:
+  """PATH 1 for several small documents in one call
+
+  documents holds (name, content label, content) triples. The model is asked
+  for one headed section per document, and the response is split back into
+  {name: analysis}; on_text receives (name, delta) as sections stream in.
+  Documents the model left out are missing from the result.
+  """
+  names = [name for name, _, _ in documents]
+  document_text = "\n\n".join(
+    f"DOCUMENT {i}: {name}\n{content_label}:\n{content}"
+    for i, (name, content_label, content) in enumerate(documents, start=1)
+  )
+  headings = "\n".join(section_heading(name) for name in names)
+  batch_prompt = f"""Analyze each of the following {len(documents)} state requirements documents separately and provide feedback on how it relates to the user's question.
+
+{document_text}
+
+For each document, in the order given, start its section with its heading line exactly as written here:
+{headings}
+
+Under each heading, provide for that document only:
+1. Key requirements from the document
+2. How these requirements relate to the user's question
+3. Specific feedback on alignment or gaps
+4. Recommendations based on the state requirements
+
+Focus on being specific and citing exact requirements from each document, including their page references. Never merge documents into one section."""
+
+  question_prompt = f"""USER QUESTION: {user_message}
+FILTER CONTEXT: {filter_context}"""
+
+  router = SectionRouter(names, on_text) if on_text is not None else None
+  batch_messages = build_prompt_messages(batch_prompt, question_prompt, cache_prompt)
+  text = converse_text(bedrock_client, batch_messages, min(8192, 1500 * len(documents)), router.feed if router else None, span)
+  if router is not None:
+    router.close()
+  return split_analyses(text, names)
+
+def map_document_section(bedrock_client: Any, name: str, label: str, content: str, span: Optional[Span] = None) -> str:
+  """PATH 1 map step: the requirements in one section of a document too large for a single prompt.
+
+  The notes do not depend on the question, so they can be cached by the
+  section's content and reused by every later question and revision.
+  """
+  section_prompt = f"""You are reading one section of a longer state requirements document. Extract the requirements it sets out.
+
+DOCUMENT: {name}
+SECTION: {label}
+{content}
+
+List concisely:
+1. Each requirement in this section, quoted or closely paraphrased, with its page reference
+2. Definitions, deadlines, thresholds and exceptions those requirements depend on
+
+If this section sets out no requirements, reply exactly: {NO_RELEVANT_REQUIREMENTS}"""
+
+  return converse_text(bedrock_client, [{"role": "user", "content": [{"text": section_prompt}]}], 1200, span=span)
+
+def map_reduce_state_document(bedrock_client: Any, name: str, document: Any, user_message: str, filter_context: str,
+                              on_text: Optional[Callable[[str], None]] = None, trace: Optional[Trace] = None,
+                              parent: Optional[Span] = None, analysis_cache: Optional[AnalysisCache] = None) -> str:
+  """PATH 1 for documents larger than one section.
+
+  The requirements of each token-budgeted section are extracted
+  concurrently, independently of the question; only the reduce step, which
+  turns those notes into the usual analysis, sees the question. Notes that
+  still do not fit in one prompt are condensed again first. With
+  analysis_cache, section notes are cached by content alone, so a new
+  question about the document costs one call, and a revised document only
+  has its new or changed sections extracted again.
+  """
+  trace = trace or Trace("map_reduce")
+
+  def cached(span: Span, key: str, analyze: Callable[[], str]) -> Tuple[str, bool]:
+    if analysis_cache is None:
+      return analyze(), False
+    text = analysis_cache.get(key)
+    span.set(**{CACHE_OUTCOME: "miss" if text is None else "hit"})
+    if text is not None:
+      return text, True
+    text = analyze()
+    analysis_cache.put(key, text)
+    return text, False
+
+  def map_notes(sections: List[Tuple[str, str]], stage: str) -> List[Tuple[str, str]]:
+    def map_one(section):
+      label, content = section
+      with trace.span(stage, parent, **{"document.name": name, "section": label}) as span:
+        key = AnalysisCache.make_key(text_hash(f"{name}\n{label}\n{content}"), "", "", MODEL_ID, "section")
+        notes, reused = cached(span, key, lambda: map_document_section(bedrock_client, name, label, content, span))
+      return label, notes, reused
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAP_REDUCE_PARALLELISM, len(sections)))) as executor:
+      mapped = list(executor.map(map_one, sections))
+    if parent is not None and stage == "path1.map":
+      parent.set(**{"sections.total": len(mapped), "sections.reused": sum(reused for _, _, reused in mapped)})
+    return [(label, notes) for label, notes, _ in mapped if NO_RELEVANT_REQUIREMENTS not in notes]
+
+  def join_notes(notes: List[Tuple[str, str]]) -> str:
+    return "\n\n".join(f"[{label}]\n{text}" for label, text in notes)
+
+  notes = map_notes(split_sections(document), "path1.map")
+  while len(notes) > 1 and estimate_tokens(join_notes(notes)) > SINGLE_SHOT_TOKEN_LIMIT:
+    # Group neighbouring notes into section-sized batches and condense each batch
+    groups, group, group_tokens = [], [], 0
+    for label, text in notes:
+      tokens = estimate_tokens(text)
+      if group and group_tokens + tokens > SECTION_TOKENS:
+        groups.append(group)
+        group, group_tokens = [], 0
+      group.append((label, text))
+      group_tokens += tokens
+    groups.append(group)
+    if len(groups) == len(notes):
+      break
+    notes = map_notes([(f"{group[0][0]} to {group[-1][0]}", join_notes(group)) for group in groups], "path1.condense")
+
+  if not notes:
+    notes = [("whole document", "No requirements were found in any section of the document.")]
+  with trace.span("path1.reduce", parent, **{"document.name": name, "notes": len(notes)}) as span:
+    key = AnalysisCache.make_key(text_hash(f"{name}\n{join_notes(notes)}"), user_message, filter_context, MODEL_ID, "reduce")
+    analysis, reused = cached(span, key, lambda: analyze_state_document(
+      bedrock_client, name, join_notes(notes), user_message, filter_context, on_text, span,
+      content_label="NOTES FROM EACH SECTION OF THE DOCUMENT (with page references)"))
+  if reused and on_text is not None:
+    on_text(analysis)
+  return analysis
+
+def retrieve_knowledge_base(rag_client: Any, user_message: str,
+                            retrieval_cache: Optional[RetrievalCache] = None,
+                            metadata_filter: Optional[Dict[str, Any]] = None,
+                            number_of_results: int = RETRIEVAL_CANDIDATES) -> Tuple[List[Dict[str, Any]], str]:
+  """PATH 2: retrieve relevant documents from the knowledge base
+
+  Returns the retrieval results and the cache outcome (hit, coalesced, miss or uncached).
+  """
+  knowledge_base_id = os.getenv('KNOWLEDGE_BASE_ID')
+  retrieval_configuration = {
+    'vectorSearchConfiguration': {
+      'numberOfResults': number_of_results
+    }
+  }
+  if metadata_filter:
+    retrieval_configuration['vectorSearchConfiguration']['filter'] = metadata_filter
+
+  def fetch():
+    retrieval_response = rag_client.retrieve(
+      knowledgeBaseId=knowledge_base_id,
+      retrievalQuery={'text': user_message},
+      retrievalConfiguration=retrieval_configuration
+    )
+    return retrieval_response.get('retrievalResults', [])
+
+  if retrieval_cache is None:
+    return fetch(), "uncached"
+
+  cache_key = RetrievalCache.make_key(user_message, knowledge_base_id, retrieval_configuration)
+  return retrieval_cache.get_or_fetch(cache_key, fetch)
+
+def build_knowledge_base_matches(retrieved_docs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+  """Turn retrieval results into citation info keyed by match label"""
+  knowledge_base_matches = {}
+
+  for i, doc in enumerate(retrieved_docs):
+    # Extract comprehensive source information
+    metadata = doc.get('metadata', {})
+    source = metadata.get('source', 'Knowledge Base Document')
+    location = metadata.get('location', '')
+
+    # Try to extract more detailed information from various possible fields
+    title = metadata.get('title', '') or metadata.get('name', '') or metadata.get('document_title', '')
+
+    # Look for URLs in multiple possible fields (including AWS Bedrock specific fields)
+    url = ''
+    possible_url_fields = ['x-amz-bedrock-kb-source-uri', 'url', 'source', 'uri', 'link', 'href', 'web_url', 'document_uri', 'file_uri', 'source_uri']
+    for field in possible_url_fields:
+      if field in metadata and metadata[field] and 'http' in str(metadata[field]):
+        url = metadata[field]
+        break
+
+    page = metadata.get('page', '') or metadata.get('page_number', '')
+    section = metadata.get('section', '') or metadata.get('chapter', '')
+
+    # Create a more descriptive source name
+    if title:
+      source_name = title
+    elif url:
+      source_name = url.split('/')[-1] if '/' in url else url
+    elif source and source != 'Knowledge Base Document':
+      source_name = source
+    else:
+      # Try to extract meaningful info from content
+      content_preview = doc['content']['text'][:100].replace('\n', ' ')
+      if 'Filipino' in content_preview:
+        source_name = f"Filipino Immigration Source {i+1}"
+      elif 'Asian' in content_preview:
+        source_name = f"Asian American History Source {i+1}"
+      elif 'immigration' in content_preview.lower():
+        source_name = f"Immigration History Source {i+1}"
+      else:
+        source_name = f"Knowledge Base Document {i+1}"
+
+    # Create detailed citation info
+    citation_info = {
+      'source': source_name,
+      'original_source': source,
+      'location': location,
+      'url': url,
+      'page': page,
+      'section': section,
+      'content': doc['content']['text'],
+      'match_number': i + 1,
+      'metadata': metadata
+    }
+
+    key = f"Match {i+1}: {source_name}"
+    knowledge_base_matches[key] = citation_info
+
+  return knowledge_base_matches
+
+def synthesize_knowledge_base(bedrock_client: Any, user_message: str, filter_context: str,
+                              knowledge_base_matches: Dict[str, Dict[str, Any]], state_requirements_response: str,
+                              on_text: Optional[Callable[[str], None]] = None, span: Optional[Span] = None) -> str:
+  """PATH 2: send the knowledge base matches and the state summary to the LLM"""
+  # Format matches with citation information
+  matches_text = ""
+  citations_list = []
+  
+  for key, citation_info in knowledge_base_matches.items():
+    matches_text += f"{key}:\nSource: {citation_info['source']}\nLocation: {citation_info['location']}\nURL: {citation_info['url']}\nContent: {citation_info['content']}\n\n"
+    
+    # Create clickable citation with URL if available
+    if citation_info['url']:
+      citations_list.append(f"[{citation_info['match_number']}] {citation_info['source']} - {citation_info['location']} | URL: {citation_info['url']}")
+    else:
+      citations_list.append(f"[{citation_info['match_number']}] {citation_info['source']} - {citation_info['location']}")
+  
+  # Instructions, matches and citations come first so they can be cached;
+  # the question and the state summary change every turn and come last
+  knowledge_prompt = f"""Based on the following matches from our knowledge base, provide feedback on the user's question.
+
+KNOWLEDGE BASE MATCHES:
+{matches_text}
+
+Please provide:
+1. Specific feedback using the knowledge base content
+2. Quote relevant sections with proper citations (use format: "Quote text" [Citation #])
+3. Explain how the matches relate to the user's question
+4. Highlight key insights from the knowledge base
+
+CITATION FORMAT: When quoting, use this format: "Exact quote text" [1] where the number refers to the citation list below.
+
+CITATIONS:
+{chr(10).join(citations_list)}
+
+CRITICAL: Always provide proper citations with [number] format when referencing knowledge base content."""
+
+  question_prompt = f"""USER QUESTION: {user_message}
+FILTER CONTEXT: {filter_context}
+
+STATE STANDARDS SUMMARY:
+{state_requirements_response}"""
+
+  knowledge_messages = build_prompt_messages(knowledge_prompt, question_prompt)
+  return converse_text(bedrock_client, knowledge_messages, 1500, on_text, span)
+
+def format_metadata_debug(knowledge_base_matches: Dict[str, Dict[str, Any]]) -> str:
+  """Metadata fields of each knowledge base match, kept apart from the response"""
+  if not knowledge_base_matches:
+    return ""
+  debug_section = "### 🔍 **METADATA DEBUG INFO**\n"
+  debug_section += "*This shows what metadata fields are available in your knowledge base*\n\n"
+
+  for i, citation_info in enumerate(knowledge_base_matches.values()):
+    debug_section += f"**Document {i+1} Metadata Fields:**\n"
+    metadata = citation_info.get('metadata', {})
+    for key, value in metadata.items():
+      debug_section += f"  - {key}: {value}\n"
+    debug_section += "\n"
+
+  return debug_section
+
+def format_final_response(user_message: str, state_requirements_response: str, knowledge_base_response: str,
+                          knowledge_base_matches: Dict[str, Dict[str, Any]]) -> str:
+  """Combine both paths and the citations into the final markdown answer"""
+  # Create citations section if we have knowledge base matches
+  citations_section = ""
+  if knowledge_base_matches:
+    citations_section = "\n\n## 📚 CITATIONS\n"
+    citations_section += "*Sources retrieved from AWS Bedrock Knowledge Base*\n\n"
+    citations_section += "### 📖 **CITATIONS**\n\n"
+    
+    for citation_info in knowledge_base_matches.values():
+      if citation_info['url'] and citation_info['url'].startswith('http'):
+        # Create clickable hyperlink
+        citations_section += f"[{citation_info['match_number']}] [{citation_info['source']}]({citation_info['url']})\n\n"
+      else:
+        # Provide more context for knowledge base sources
+        content_preview = citation_info['content'][:150].replace('\n', ' ')
+        citations_section += f"[{citation_info['match_number']}] {citation_info['source']}\n   📄 Content Preview: {content_preview}...\n   ⚠️ *No URL available in knowledge base metadata*\n\n"
+  
+  final_response = f"""# ANALYSIS RESULTS
+
+## 📄 STATE REQUIREMENTS ANALYSIS
+{state_requirements_response if state_requirements_response else "No state requirements documents provided."}
+
+## 🗄️ KNOWLEDGE BASE ANALYSIS  
+{knowledge_base_response if knowledge_base_response else "No knowledge base matches found."}
+
+## 🎯 SUMMARY
+Based on both the state requirements and knowledge base analysis, here are the key findings and recommendations for your question: "{user_message}"
+{citations_section}
+"""
+  
+  return final_response
+
+def run_pipeline(user_message: str, context: Optional[Dict[str, Any]], bedrock_client: Any, rag_client: Any,
+                 analysis_cache: Optional[AnalysisCache] = None, retrieval_cache: Optional[RetrievalCache] = None,
+                 listener: Optional[PipelineListener] = None, stream: bool = False,
+                 stats: Optional[Dict[str, Any]] = None, trace: Optional[Trace] = None) -> str:
+  """Run both paths for a question and return the combined markdown response.
+
+  context holds the filter selections (states, grade, subject) and optionally
+  documents ({name: stored document}) with their document_indexes. Per-run
+  cache counters, stage timings, token usage and the knowledge base metadata
+  debug text are written to stats when it is given, and every stage is
+  recorded as a span of trace.
+  """
+  listener = listener or PipelineListener()
+  run_started = time.perf_counter()
+  timings: Dict[str, Any] = {"documents": {}}
+
+  filter_context = build_filter_context(context)
+  selections = filter_selections(context)
+  metadata_filter = build_metadata_filter(selections)
+  documents = context.get("documents") if context else None
+  document_indexes = context.get("document_indexes", {}) if context else {}
+  analysis_mode = context.get("analysis_mode", PASSAGES_MODE) if context else PASSAGES_MODE
+
+  trace = trace or Trace("pipeline")
+  trace.root.set(**{"pipeline.documents": len(documents or {}), "pipeline.stream": stream, "gen_ai.request.model": MODEL_ID})
+
+  def traced_retrieval():
+    with trace.span("path2.retrieve", **{"retrieval.filtered": metadata_filter is not None}) as span:
+      retrieved_docs, outcome = retrieve_knowledge_base(rag_client, user_message, retrieval_cache, metadata_filter)
+      if metadata_filter is not None and not retrieved_docs:
+        # Nothing is tagged with the selections; search everything and let the reranker favour matching metadata
+        retrieved_docs, outcome = retrieve_knowledge_base(rag_client, user_message, retrieval_cache)
+        span.set(**{"retrieval.filter_fallback": True})
+      span.set(**{CACHE_OUTCOME: outcome, "retrieval.results": len(retrieved_docs)})
+    return (retrieved_docs, outcome), span.duration
+
+  def traced_analysis(name, content, on_text, content_label, cache_prompt):
+    with trace.span("path1.converse", **{"document.name": name}) as span:
+      analysis = analyze_state_document(bedrock_client, name, content, user_message, filter_context, on_text, span,
+                                        content_label, cache_prompt)
+    return {name: analysis}, span.duration
+
+  def traced_full_analysis(name, document, tokens, on_text):
+    # Anything larger than one section is built from per-section requirement notes, which are cached
+    # by content: later questions reuse all of them and a revision only has its changed sections read again
+    strategy = "single_shot" if tokens <= SECTION_TOKENS else "map_reduce"
+    with trace.span("path1.analyze", **{"document.name": name, "document.tokens_estimate": tokens, "analysis.strategy": strategy}) as span:
+      if strategy == "map_reduce":
+        analysis = map_reduce_state_document(bedrock_client, name, document, user_message, filter_context, on_text, trace, span,
+                                             analysis_cache)
+      else:
+        with trace.span("path1.converse", span, **{"document.name": name}) as converse_span:
+          analysis = analyze_state_document(bedrock_client, name, format_pages(document), user_message, filter_context, on_text,
+                                            converse_span, content_label="DOCUMENT TEXT (with page references)", cache_prompt=True)
+    return {name: analysis}, span.duration
+
+  def traced_batch_analysis(batch, stream_to):
+    cache_prompt = all(item["full_document"] for item in batch)
+    with trace.span("path1.batch", **{"batch.documents": len(batch), "batch.tokens_estimate": sum(item["tokens"] for item in batch)}) as span:
+      with trace.span("path1.converse", span, **{"document.name": ", ".join(item["name"] for item in batch)}) as converse_span:
+        analyses = analyze_document_batch(bedrock_client, [(item["name"], item["label"], item["content"]) for item in batch],
+                                          user_message, filter_context, stream_to, converse_span, cache_prompt)
+      # Documents the model left out of its answer are analyzed on their own
+      for item in batch:
+        if item["name"] not in analyses:
+          on_text = (lambda text, name=item["name"]: stream_to(name, text)) if stream_to else None
+          with trace.span("path1.converse", span, **{"document.name": item["name"], "batch.retry": True}) as retry_span:
+            analyses[item["name"]] = analyze_state_document(bedrock_client, item["name"], item["content"], user_message, filter_context,
+                                                            on_text, retry_span, item["label"], cache_prompt)
+    return analyses, span.duration
+
+  listener.status("info", "🚀 **STARTING PARALLEL PROCESSING** - Two paths: State Requirements & RAG Knowledge Base")
+
+  state_requirements_response = ""
+  knowledge_base_matches = {}
+  knowledge_base_response = ""
+  retrieval_ok = False
+  retrieval_outcome = None
+
+  # Streamed PATH 1 deltas are queued by the workers and handed to the listener from this thread
+  stream_updates = queue.Queue()
+
+  def drain_stream_updates():
+    while True:
+      try:
+        name, text = stream_updates.get_nowait()
+      except queue.Empty:
+        return
+      listener.document_text(name, text)
+
+  # Both paths share one bounded pool: the per-document analyses fan out while
+  # the knowledge base retrieval runs alongside them. The listener is only
+  # called from this thread, the workers just talk to Bedrock.
+  max_workers = max(1, min(MAX_PARALLEL_REQUESTS, len(documents or {}) + 1))
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # PATH 2: User Prompt → RAG → Knowledge Base (submitted first so it never queues behind PATH 1)
+    listener.status("info", "🔍 **PATH 2: RAG KNOWLEDGE BASE SEARCH** - Searching for matches...")
+    retrieval_future = executor.submit(traced_retrieval)
+
+    # PATH 1: State Requirements PDF → LLM; large documents get their own calls, small ones share batched calls
+    document_futures = {}
+    analyses_to_run = {}
+    document_analyses = {}
+    state_error = None
+    cache_hits = 0
+    cache_misses = 0
+    if documents:
+      listener.status("info", f"📄 **PATH 1: STATE REQUIREMENTS ANALYSIS** - Processing {len(documents)} uploaded document(s) in parallel...")
+      for name, document in documents.items():
+        if stream:
+          listener.document_started(name)
+
+        # Documents without a passage index are always analyzed in full
+        full_document = analysis_mode == FULL_DOCUMENT_MODE or name not in document_indexes
+
+        if full_document:
+          # Same document, question, filters and model: reuse the earlier analysis
+          cache_key = AnalysisCache.make_key(document.file_hash, user_message, filter_context, MODEL_ID, FULL_DOCUMENT_MODE)
+        else:
+          # Only the passages most relevant to the question are sent, not the whole file. The
+          # analysis is keyed by what is sent, so a revision that only changes other parts of
+          # the document keeps its cached analysis.
+          with trace.span("path1.passages", **{"document.name": name}) as span:
+            content = document_indexes[name].relevant_passages(user_message, PASSAGES_PER_DOCUMENT)
+            span.set(**{"passages.chars": len(content)})
+          cache_key = AnalysisCache.make_key(text_hash(f"{name}\n{content}"), user_message, filter_context, MODEL_ID, PASSAGES_MODE)
+        cached_analysis = None
+        if analysis_cache is not None:
+          with trace.span("path1.cache", **{"document.name": name}) as span:
+            cached_analysis = analysis_cache.get(cache_key)
+            span.set(**{CACHE_OUTCOME: "miss" if cached_analysis is None else "hit"})
+        if cached_analysis is not None:
+          cache_hits += 1
+          document_analyses[name] = cached_analysis
+          timings["documents"][name] = 0.0
+          if stream:
+            listener.document_text(name, cached_analysis)
+          listener.document_complete(name, cached_analysis)
+          listener.status("success", f"✅ **PATH 1** - {name} analyzed (cached)")
+          continue
+        cache_misses += 1
+
+        # The size of the source document, not of what is sent, decides whether it may share a call:
+        # the answer about a large document is long however few passages of it are sent
+        tokens = estimate_document_tokens(document)
+        if full_document:
+          # Between one prompt, a shared batch and map-reduce over sections
+          if tokens > BATCH_DOCUMENT_TOKENS:
+            if tokens > SECTION_TOKENS:
+              listener.status("info", f"🧩 **PATH 1** - Analyzing {name} (~{tokens:,} tokens) section by section...")
+            on_text = (lambda text, name=name: stream_updates.put((name, text))) if stream else None
+            future = executor.submit(traced_full_analysis, name, document, tokens, on_text)
+            document_futures[future] = [(name, cache_key)]
+            continue
+          label, content = "DOCUMENT TEXT (with page references)", format_pages(document)
+        else:
+          label = "RELEVANT PASSAGES (with page references)"
+        analyses_to_run[name] = {"name": name, "cache_key": cache_key, "label": label, "content": content,
+                                 "tokens": estimate_tokens(content), "full_document": full_document,
+                                 "batchable": tokens <= BATCH_DOCUMENT_TOKENS}
+
+      stream_to = (lambda name, text: stream_updates.put((name, text))) if stream else None
+      batchable = [(name, item["tokens"]) for name, item in analyses_to_run.items() if item["batchable"]]
+      # Large documents first: theirs are the longest calls
+      batches = [[name] for name, item in analyses_to_run.items() if not item["batchable"]] + plan_batches(batchable)
+      for batch in batches:
+        items = [analyses_to_run[name] for name in batch]
+        if len(items) == 1:
+          item = items[0]
+          on_text = (lambda text, name=item["name"]: stream_to(name, text)) if stream else None
+          future = executor.submit(traced_analysis, item["name"], item["content"], on_text, item["label"], item["full_document"])
+        else:
+          listener.status("info", f"📦 **PATH 1** - Analyzing {len(items)} small documents in one request: {', '.join(batch)}")
+          future = executor.submit(traced_batch_analysis, items, stream_to)
+        document_futures[future] = [(item["name"], item["cache_key"]) for item in items]
+
+    pending = {retrieval_future, *document_futures}
+    while pending:
+      done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+      drain_stream_updates()
+
+      for future in done:
+        if future is retrieval_future:
+          try:
+            (retrieved_docs, retrieval_outcome), timings["retrieval"] = future.result()
+            # Only the best distinct chunks, within the token budget, go to the synthesis prompt
+            with trace.span("path2.rerank") as span:
+              selected_docs, rerank_stats = select_matches(retrieved_docs, user_message, selections)
+              span.set(**{f"rerank.{key}": value for key, value in rerank_stats.items()})
+            with trace.span("path2.citations") as span:
+              knowledge_base_matches = build_knowledge_base_matches(selected_docs)
+              span.set(**{"citations.count": len(knowledge_base_matches)})
+            retrieval_ok = True
+            cache_note = {"hit": " (cached)", "coalesced": " (shared with a concurrent identical query)"}.get(retrieval_outcome, "")
+            listener.status("success", f"📚 **PATH 2 RETRIEVAL COMPLETE** - Found {len(retrieved_docs)} matches from knowledge base{cache_note}, "
+                                       f"kept the best {len(selected_docs)} (~{rerank_stats['tokens']:,} tokens)")
+            if selected_docs:
+              listener.retrieval_complete(selected_docs)
+          except Exception as e:
+            knowledge_base_response = f"Error processing knowledge base: {str(e)}"
+            listener.status("error", f"❌ **PATH 2 ERROR** - {str(e)}")
+          continue
+
+        entries = document_futures[future]
+        if state_error is not None or future.cancelled():
+          continue
+        try:
+          analyses, duration = future.result()
+          for name, cache_key in entries:
+            document_analyses[name], timings["documents"][name] = analyses[name], duration
+            if analysis_cache is not None:
+              analysis_cache.put(cache_key, document_analyses[name])
+            listener.document_complete(name, document_analyses[name])
+            listener.status("success", f"✅ **PATH 1** - {name} analyzed" + (" (batched)" if len(entries) > 1 else ""))
+        except Exception as e:
+          # Any failed document fails PATH 1 as a whole, so stop queued analyses
+          state_error = e
+          for queued in document_futures:
+            queued.cancel()
+
+  timings["parallel_paths"] = time.perf_counter() - run_started
+
+  if stats is not None:
+    if retrieval_ok:
+      retrieval_totals = retrieval_cache.stats() if retrieval_cache is not None else {}
+      stats["retrieval_cache"] = {"outcome": retrieval_outcome, **retrieval_totals}
+    if analysis_cache is not None:
+      cache_totals = analysis_cache.stats()
+      stats["analysis_cache"] = {
+        "hits": cache_hits,
+        "misses": cache_misses,
+        "total_hits": cache_totals["hits"],
+        "total_misses": cache_totals["misses"]
+      }
+
+  if documents:
+    if state_error is None:
+      # Keep the sections in upload order regardless of completion order
+      for name in documents:
+        state_requirements_response += f"\n\n{section_heading(name)}\n"
+        state_requirements_response += document_analyses[name]
+      listener.status("success", "✅ **PATH 1 COMPLETE** - State requirements analyzed")
+    else:
+      state_requirements_response = f"Error analyzing state requirements: {str(state_error)}"
+      listener.status("error", f"❌ **PATH 1 ERROR** - {str(state_error)}")
+
+  # PATH 2: Send matches to LLM for feedback (the only step that waits on PATH 1)
+  if retrieval_ok and knowledge_base_matches:
+    try:
+      listener.status("info", "🤖 **PATH 2: LLM FEEDBACK** - Processing knowledge base matches...")
+      on_text = None
+      if stream:
+        listener.synthesis_started()
+        on_text = listener.synthesis_text
+      with trace.span("path2.converse", **{"citations.count": len(knowledge_base_matches)}) as span:
+        knowledge_base_response = synthesize_knowledge_base(
+          bedrock_client, user_message, filter_context, knowledge_base_matches, state_requirements_response, on_text, span
+        )
+      timings["synthesis"] = span.duration
+      listener.synthesis_complete(knowledge_base_response)
+      listener.status("success", "✅ **PATH 2 COMPLETE** - Knowledge base matches processed")
+
+    except Exception as e:
+      knowledge_base_response = f"Error processing knowledge base: {str(e)}"
+      listener.status("error", f"❌ **PATH 2 ERROR** - {str(e)}")
+
+  # COMBINE BOTH RESPONSES
+  listener.status("info", "🔄 **COMBINING RESPONSES** - Merging both analyses...")
+  with trace.span("combine"):
+    final_response = format_final_response(user_message, state_requirements_response, knowledge_base_response, knowledge_base_matches)
+  listener.status("success", "✅ **FINAL RESPONSE GENERATED** - Both paths completed successfully")
+
+  timings["total"] = time.perf_counter() - run_started
+  trace.end()
+  if stats is not None:
+    stats["timings"] = timings
+    stats["usage"] = trace.usage()
+    stats["metadata_debug"] = format_metadata_debug(knowledge_base_matches)
+
+  return final_response
@@ -0,0 +1,28 @@
+"""Filter values offered in the sidebar and used by batch runs."""
+
+STATES = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", 
+    "Connecticut", "Delaware", "Florida", "Georgia", "Hawaii", "Idaho", 
+    "Illinois", "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", 
+    "Maine", "Maryland", "Massachusetts", "Michigan", "Minnesota", 
+    "Mississippi", "Missouri", "Montana", "Nebraska", "Nevada", 
+    "New Hampshire", "New Jersey", "New Mexico", "New York", 
+    "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon", 
+    "Pennsylvania", "Rhode Island", "South Carolina", "South Dakota", 
+    "Tennessee", "Texas", "Utah", "Vermont", "Virginia", "Washington", 
+    "West Virginia", "Wisconsin", "Wyoming"
+]
+
+GRADE_LEVELS = [
+    "Kindergarten", "1st Grade", "2nd Grade", "3rd Grade", 
+    "4th Grade", "5th Grade", "6th Grade", "7th Grade", "8th Grade", 
+    "9th Grade", "10th Grade", "11th Grade", "12th Grade"
+]
+
+SUBJECTS = [
+    "English", "Social Studies", "U.S. History", "World History"
+]
+
+# Sidebar choices, with the entry that turns each filter off first
+GRADE_OPTIONS = ["All Grades"] + GRADE_LEVELS
+SUBJECT_OPTIONS = ["All Subjects"] + SUBJECTS
@@ -0,0 +1,116 @@
+"""Knowledge base retrieval filters and local reranking.
+
+Once the KB_*_METADATA_KEY variables name the keys the knowledge base is
+tagged with, the sidebar selections become metadata filters on the Retrieve
+call. More
+results than the prompt needs are retrieved and then reranked locally by
+vector score, overlap with the question and matching metadata. Near-duplicate
+chunks are dropped, and the best chunks are kept within a token budget for
+the PATH 2 prompt.
+"""
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from document_index import tokenize
+from sections import estimate_tokens
+
+# Metadata keys the knowledge base documents are tagged with. Unset (the default), a selection
+# is not filtered on: on an untagged knowledge base every filtered search would come back
+# empty and have to be repeated without the filter.
+STATE_METADATA_KEY = os.getenv("KB_STATE_METADATA_KEY", "")
+GRADE_METADATA_KEY = os.getenv("KB_GRADE_METADATA_KEY", "")
+SUBJECT_METADATA_KEY = os.getenv("KB_SUBJECT_METADATA_KEY", "")
+
+# Results retrieved before reranking, and the most kept after it
+RETRIEVAL_CANDIDATES = int(os.getenv("KB_RETRIEVAL_CANDIDATES", "20"))
+MAX_MATCHES = int(os.getenv("KB_MAX_MATCHES", "5"))
+
+# Estimated tokens of knowledge base content sent to the PATH 2 prompt
+MATCH_TOKEN_BUDGET = int(os.getenv("KB_MATCH_TOKEN_BUDGET", "3000"))
+
+# Chunks sharing at least this fraction of their words (Jaccard) are near-duplicates
+DUPLICATE_SIMILARITY = 0.8
+
+# Added to the score for each selected filter a chunk's metadata matches
+METADATA_BOOST = 0.25
+
+
+def filter_selections(context: Optional[Dict[str, Any]]) -> List[Tuple[str, List[str]]]:
+    """(metadata key, selected values) for each sidebar filter that narrows the search"""
+    if not context:
+        return []
+    grade = context.get("grade")
+    subject = context.get("subject")
+    selections = [
+        (STATE_METADATA_KEY, list(context.get("states") or [])),
+        (GRADE_METADATA_KEY, [grade] if grade and grade != "All Grades" else []),
+        (SUBJECT_METADATA_KEY, [subject] if subject and subject != "All Subjects" else [])
+    ]
+    return [(key, values) for key, values in selections if key and values]
+
+
+def build_metadata_filter(selections: List[Tuple[str, List[str]]]) -> Optional[Dict[str, Any]]:
+    """Retrieve filter requiring every selection to match, or None when nothing is selected"""
+    conditions = [{"in": {"key": key, "value": values}} for key, values in selections]
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"andAll": conditions}
+
+
+def _metadata_matches(metadata: Dict[str, Any], selections: List[Tuple[str, List[str]]]) -> int:
+    """How many selections the chunk's metadata agrees with"""
+    matches = 0
+    for key, values in selections:
+        value = metadata.get(key)
+        tagged = value if isinstance(value, list) else [value]
+        wanted = {v.lower() for v in values}
+        if any(str(v).lower() in wanted for v in tagged if v is not None):
+            matches += 1
+    return matches
+
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def select_matches(retrieved_docs: List[Dict[str, Any]], question: str, selections: List[Tuple[str, List[str]]],
+                   max_matches: int = MAX_MATCHES, token_budget: int = MATCH_TOKEN_BUDGET) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Best retrieval results in score order, without near-duplicates and within token_budget.
+
+    The score is the vector score plus the fraction of question words found
+    in the chunk, plus METADATA_BOOST per matching selection. The top chunk
+    is always kept, even when it alone exceeds the budget.
+    """
+    query = set(tokenize(question))
+    scored = []
+    for position, doc in enumerate(retrieved_docs):
+        text = doc.get("content", {}).get("text", "")
+        words = set(tokenize(text))
+        score = float(doc.get("score") or 0)
+        if query:
+            score += len(query & words) / len(query)
+        score += METADATA_BOOST * _metadata_matches(doc.get("metadata", {}), selections)
+        scored.append((score, position, doc, words, estimate_tokens(text)))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+
+    selected: List[Dict[str, Any]] = []
+    kept_words: List[Set[str]] = []
+    stats = {"candidates": len(retrieved_docs), "duplicates": 0, "over_budget": 0, "tokens": 0}
+    for score, _, doc, words, tokens in scored:
+        if len(selected) == max_matches:
+            break
+        if any(_similarity(words, other) >= DUPLICATE_SIMILARITY for other in kept_words):
+            stats["duplicates"] += 1
+            continue
+        if selected and stats["tokens"] + tokens > token_budget:
+            stats["over_budget"] += 1
+            continue
+        selected.append(doc)
+        kept_words.append(words)
+        stats["tokens"] += tokens
+    stats["selected"] = len(selected)
+    return selected, stats
@@ -0,0 +1,68 @@
+"""Process-wide resources of the Streamlit app.
+
+Streamlit re-executes app.py on every interaction, while imported modules run
+once per process. The stores, caches and Bedrock clients shared by every
+session are set up here, each on first use, so a rerun only looks them up.
+The Bedrock clients (and boto3 with them) are created when the first
+question is asked, not when the page loads. Questions run on the job queue's
+worker threads, which are handed these objects rather than looking them up.
+"""
+from typing import Any, Optional
+
+import streamlit as st
+
+from caching import AnalysisCache, RetrievalCache
+from document_store import DocumentStore
+from jobs import JobQueue
+from standards_library import StandardsLibrary
+from telemetry import TraceExporter
+
+
+@st.cache_resource
+def get_document_store() -> DocumentStore:
+    """On-disk store of extracted document text shared by every session"""
+    return DocumentStore()
+
+
+@st.cache_resource
+def get_standards_library() -> StandardsLibrary:
+    """Pre-indexed state standards shared by every session"""
+    return StandardsLibrary()
+
+
+@st.cache_resource
+def get_trace_exporter() -> Optional[TraceExporter]:
+    """Appends traces to TRACE_EXPORT_PATH when it is set"""
+    return TraceExporter.from_env()
+
+
+@st.cache_resource
+def get_rag_client() -> Any:
+    """Client for RAG (Knowledge Base) operations"""
+    from clients import create_rag_client
+    return create_rag_client()
+
+
+@st.cache_resource
+def get_bedrock_client() -> Any:
+    """Client for regular Bedrock LLM operations"""
+    from clients import create_bedrock_client
+    return create_bedrock_client()
+
+
+@st.cache_resource
+def get_analysis_cache() -> AnalysisCache:
+    """PATH 1 analysis cache shared by every session"""
+    return AnalysisCache.from_env()
+
+
+@st.cache_resource
+def get_retrieval_cache() -> RetrievalCache:
+    """Knowledge base retrieval cache shared by every session"""
+    return RetrievalCache.from_env()
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Background pipeline jobs shared by every session"""
+    return JobQueue.from_env()
@@ -0,0 +1,140 @@
+"""Token estimates and token-budgeted sections of a document.
+
+Used to decide whether a whole document fits in one prompt and, when it does
+not, to split it along page boundaries into sections that each do. Section
+boundaries are chosen from page content, so editing one page of a revised
+document leaves the other sections, and their cached analyses, unchanged.
+"""
+import hashlib
+import math
+import os
+import re
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+# Roughly four characters per token for English prose
+CHARS_PER_TOKEN = 4
+
+# Section notes estimated above this many tokens are condensed before they are combined
+SINGLE_SHOT_TOKEN_LIMIT = int(os.getenv("SINGLE_SHOT_TOKEN_LIMIT", "30000"))
+
+# Token budget of each section; full document analyses of anything larger are built from section notes
+SECTION_TOKENS = int(os.getenv("MAP_SECTION_TOKENS", "8000"))
+
+# A section may end after any page once it is this full, at pages whose hash picks them as boundaries
+SECTION_MIN_FILL = 0.5
+BOUNDARY_DIVISOR = 4
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def text_hash(text: str) -> str:
+    """SHA-256 of text, for content-addressed cache keys"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _is_boundary(page: str) -> bool:
+    """Whether a section may end after this page, decided by its content alone"""
+    return int(text_hash(page)[:8], 16) % BOUNDARY_DIVISOR == 0
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_document_tokens(document: Any) -> int:
+    """Token estimate for a stored document (from its size) or any paged source"""
+    size = getattr(document, "size", None)
+    if size is None:
+        size = sum(len(page) for page in document.iter_pages())
+    return math.ceil(size / CHARS_PER_TOKEN)
+
+
+def _page_label(document: Any, first: int, last: int) -> str:
+    unit = "p." if document.paged else "part"
+    return f"{unit} {first}" if first == last else f"{unit} {first}-{last}"
+
+
+def _split_text(text: str, max_chars: int) -> Iterator[str]:
+    """Pieces of at most max_chars, broken at paragraph or word boundaries where possible"""
+    while len(text) > max_chars:
+        cut = text.rfind("\n\n", 0, max_chars)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        yield text[:cut]
+        text = text[cut:].lstrip()
+    if text.strip():
+        yield text
+
+
+def format_pages(document: Any) -> str:
+    """Whole document text with a page (or part) reference before each page"""
+    return "\n\n".join(
+        f"[{_page_label(document, number, number)}] {PARAGRAPH_BREAK.sub(chr(10), page.strip())}"
+        for number, page in enumerate(document.iter_pages(), start=1)
+        if page.strip()
+    )
+
+
+def split_sections(document: Any, section_tokens: int = SECTION_TOKENS) -> List[Tuple[str, str]]:
+    """(label, text) sections of whole pages, each within section_tokens where possible.
+
+    Consecutive pages are packed together. Once a section is SECTION_MIN_FILL
+    full it ends after the next page whose content marks a boundary, so
+    boundaries resynchronize right after an edited page instead of shifting
+    through the rest of the document. A single page larger than the budget is
+    split into several sections of its own.
+    """
+    max_chars = section_tokens * CHARS_PER_TOKEN
+    sections = []
+    pages: List[str] = []
+    first_page = last_page = 0
+    size = 0
+
+    def flush() -> None:
+        if pages:
+            sections.append((_page_label(document, first_page, last_page), "\n\n".join(pages)))
+
+    for number, page in enumerate(document.iter_pages(), start=1):
+        page = page.strip()
+        if not page:
+            continue
+        entry = f"[{_page_label(document, number, number)}] {page}"
+        if size + len(entry) > max_chars:
+            flush()
+            pages, size = [], 0
+        if len(entry) > max_chars:
+            pieces = list(_split_text(entry, max_chars))
+            for i, piece in enumerate(pieces, start=1):
+                sections.append((f"{_page_label(document, number, number)} ({i}/{len(pieces)})", piece))
+            continue
+        if not pages:
+            first_page = number
+        pages.append(entry)
+        last_page = number
+        size += len(entry) + 2
+        if size >= max_chars * SECTION_MIN_FILL and _is_boundary(page):
+            flush()
+            pages, size = [], 0
+
+    flush()
+    return sections
+
+
+def section_hashes(document: Any, section_tokens: int = SECTION_TOKENS) -> List[str]:
+    """Content hash of each section, in order, for comparing versions of a document"""
+    return [text_hash(f"{label}\n{text}") for label, text in split_sections(document, section_tokens)]
+
+
+def diff_sections(old: Sequence[str], new: Sequence[str]) -> Dict[str, int]:
+    """How many sections of the new version are unchanged or new/changed, and how many old ones are gone"""
+    old_counts: Dict[str, int] = {}
+    for section in old:
+        old_counts[section] = old_counts.get(section, 0) + 1
+    unchanged = 0
+    for section in new:
+        if old_counts.get(section):
+            old_counts[section] -= 1
+            unchanged += 1
+    return {"unchanged": unchanged, "changed": len(new) - unchanged, "removed": len(old) - unchanged}
@@ -0,0 +1,216 @@
+"""Server-side library of state standards documents.
+
+Frameworks that many teachers would otherwise upload (the California or Texas
+social studies frameworks, say) are extracted and indexed once, offline, and
+attached to every session that selects their state. Text is kept in a
+DocumentStore under the library directory, BM25 indexes are saved next to it,
+and a SQLite catalog maps each document to its state and subject.
+
+Documents are added with the ingestion command, using the same extractors as
+uploads:
+
+    python standards_library.py add --state California --subject "Social Studies" ca_framework.pdf
+    python standards_library.py list
+    python standards_library.py remove ca_framework.pdf
+
+The same file name may be cataloged for several states and subjects; each
+(state, subject, name) is a separate entry. Text and indexes that no entry
+refers to any more are deleted.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from document_index import DocumentIndex
+from document_store import DocumentStore, StoredDocument
+from extraction import file_type_for_path
+from reference_data import STATES, SUBJECTS
+
+LIBRARY_DIR = os.getenv("STANDARDS_LIBRARY_DIR", "standards_library")
+
+# Subject of documents that apply to every subject
+ALL_SUBJECTS = "All Subjects"
+
+
+@dataclass
+class LibraryEntry:
+    """Catalog row of one library document"""
+    name: str
+    state: str
+    subject: str
+    file_hash: str
+    size: int
+    pages: int
+    chunks: int
+    ingested_at: float
+
+
+class StandardsLibrary:
+    """Catalog of pre-extracted, pre-indexed standards documents keyed by state and subject"""
+
+    def __init__(self, root: str = LIBRARY_DIR):
+        self.root = root
+        self.store = DocumentStore(os.path.join(root, "documents"))
+        self.index_dir = os.path.join(root, "indexes")
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Loaded documents and indexes, shared by every session of the process
+        self._loaded: Dict[str, Tuple[StoredDocument, DocumentIndex]] = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "library.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "name TEXT NOT NULL, state TEXT NOT NULL, subject TEXT NOT NULL, file_hash TEXT NOT NULL, "
+            "size INTEGER NOT NULL, pages INTEGER NOT NULL, chunks INTEGER NOT NULL, ingested_at REAL NOT NULL, "
+            "PRIMARY KEY (state, subject, name))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS documents_by_state ON documents (state, subject)")
+        self._db.commit()
+
+    def add(self, path: str, state: str, subject: str = ALL_SUBJECTS, name: Optional[str] = None) -> LibraryEntry:
+        """Extract and index a file, replacing any library document of the same name, state and subject"""
+        document = self.store.ingest_path(path, file_type_for_path(path))
+        index = DocumentIndex(document)
+        index.save(self._index_path(document.file_hash))
+        entry = LibraryEntry(name or os.path.basename(path), state, subject, document.file_hash,
+                             document.size, document.page_count, index.chunk_count, time.time())
+        with self._lock:
+            replaced = self._db.execute(
+                "SELECT file_hash FROM documents WHERE state = ? AND subject = ? AND name = ?",
+                (entry.state, entry.subject, entry.name)
+            ).fetchall()
+            self._db.execute(
+                "INSERT OR REPLACE INTO documents (name, state, subject, file_hash, size, pages, chunks, ingested_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.name, entry.state, entry.subject, entry.file_hash, entry.size, entry.pages, entry.chunks, entry.ingested_at)
+            )
+            self._db.commit()
+            self._delete_unreferenced(row[0] for row in replaced)
+        return entry
+
+    def remove(self, name: str, state: Optional[str] = None, subject: Optional[str] = None) -> int:
+        """Remove the entries named name, optionally only those of a state and subject, returning how many"""
+        conditions, parameters = ["name = ?"], [name]
+        if state is not None:
+            conditions.append("state = ?")
+            parameters.append(state)
+        if subject is not None:
+            conditions.append("subject = ?")
+            parameters.append(subject)
+        where = " AND ".join(conditions)
+        with self._lock:
+            removed = self._db.execute(f"SELECT file_hash FROM documents WHERE {where}", parameters).fetchall()
+            self._db.execute(f"DELETE FROM documents WHERE {where}", parameters)
+            self._db.commit()
+            self._delete_unreferenced(row[0] for row in removed)
+        return len(removed)
+
+    def entries(self, states: Optional[List[str]] = None, subject: str = ALL_SUBJECTS) -> List[LibraryEntry]:
+        """Documents for any of the states (all states when None) that apply to subject"""
+        query = "SELECT name, state, subject, file_hash, size, pages, chunks, ingested_at FROM documents"
+        conditions, parameters = [], []
+        if states is not None:
+            if not states:
+                return []
+            conditions.append(f"state IN ({', '.join('?' for _ in states)})")
+            parameters.extend(states)
+        if subject and subject != ALL_SUBJECTS:
+            conditions.append("subject IN (?, ?)")
+            parameters.extend([subject, ALL_SUBJECTS])
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY state, name", parameters).fetchall()
+        return [LibraryEntry(*row) for row in rows]
+
+    def load(self, entry: LibraryEntry) -> Tuple[StoredDocument, DocumentIndex]:
+        """Stored text and saved index of a library document; no extraction or indexing happens here"""
+        with self._lock:
+            loaded = self._loaded.get(entry.file_hash)
+        if loaded is None:
+            document = self.store.get(entry.file_hash)
+            if document is None:
+                raise FileNotFoundError(f"Text of library document {entry.name} is missing from {self.store.root}")
+            loaded = (document, DocumentIndex.load(self._index_path(entry.file_hash), document))
+            with self._lock:
+                self._loaded[entry.file_hash] = loaded
+        return loaded
+
+    def documents_for(self, states: List[str], subject: str = ALL_SUBJECTS) -> Dict[str, Tuple[StoredDocument, DocumentIndex]]:
+        """{name: (document, index)} of every library document matching the selections.
+
+        A name cataloged for more than one of the matching states or subjects
+        is qualified with them, e.g. "framework.pdf (Texas, Social Studies)".
+        """
+        entries = self.entries(states, subject)
+        counts = Counter(entry.name for entry in entries)
+        return {
+            entry.name if counts[entry.name] == 1 else f"{entry.name} ({entry.state}, {entry.subject})": self.load(entry)
+            for entry in entries
+        }
+
+    def _index_path(self, file_hash: str) -> str:
+        return os.path.join(self.index_dir, f"{file_hash}.index")
+
+    def _delete_unreferenced(self, file_hashes: Iterable[str]) -> None:
+        """Delete the stored text and index of each file_hash no catalog entry refers to; call with the lock held"""
+        for file_hash in set(file_hashes):
+            if self._db.execute("SELECT 1 FROM documents WHERE file_hash = ? LIMIT 1", (file_hash,)).fetchone():
+                continue
+            self.store.delete(file_hash)
+            try:
+                os.remove(self._index_path(file_hash))
+            except FileNotFoundError:
+                pass
+            self._loaded.pop(file_hash, None)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the shared library of state standards documents.")
+    parser.add_argument("--library", default=LIBRARY_DIR, help=f"Library directory (default: {LIBRARY_DIR})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Extract, index and catalog PDF, DOCX or TXT files")
+    add.add_argument("paths", nargs="+", help="Files to add")
+    add.add_argument("--state", required=True, choices=STATES, help="State the documents belong to")
+    add.add_argument("--subject", default=ALL_SUBJECTS, choices=[ALL_SUBJECTS] + SUBJECTS,
+                     help=f"Subject the documents cover (default: {ALL_SUBJECTS})")
+    add.add_argument("--name", help="Library name of the document (default: file name; only with a single file)")
+
+    list_command = commands.add_parser("list", help="Show the cataloged documents")
+    list_command.add_argument("--state", action="append", choices=STATES, help="Only documents of this state (repeatable)")
+
+    remove = commands.add_parser("remove", help="Remove documents from the catalog")
+    remove.add_argument("names", nargs="+", help="Library names of the documents")
+    remove.add_argument("--state", choices=STATES, help="Only the entries of this state (default: every state)")
+    remove.add_argument("--subject", choices=[ALL_SUBJECTS] + SUBJECTS, help="Only the entries of this subject (default: every subject)")
+
+    args = parser.parse_args(argv)
+    library = StandardsLibrary(args.library)
+
+    if args.command == "add":
+        if args.name and len(args.paths) > 1:
+            parser.error("--name can only be used with a single file")
+        for path in args.paths:
+            started = time.perf_counter()
+            entry = library.add(path, args.state, args.subject, args.name)
+            print(f"Added {entry.name} ({entry.state}, {entry.subject}): {entry.pages} pages, "
+                  f"{entry.chunks} chunks in {time.perf_counter() - started:.2f}s")
+    elif args.command == "list":
+        for entry in library.entries(args.state):
+            print(f"{entry.state}\t{entry.subject}\t{entry.name}\t{entry.pages} pages\t{entry.size:,} chars")
+    else:
+        missing = [name for name in args.names if not library.remove(name, args.state, args.subject)]
+        for name in missing:
+            print(f"No library document named {name}", file=sys.stderr)
+        return 1 if missing else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
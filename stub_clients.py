@@ -0,0 +1,156 @@
+"""Offline stand-ins for the Bedrock clients.
+
+They answer converse, converse_stream and retrieve with deterministic
+generated text after a configurable delay, so the pipeline can run with no
+network (batch_eval.py --stub, benchmarks). Like a real model, a Bedrock stub
+call can also take longer the more tokens it generates.
+"""
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List
+
+# Heading lines a batched analysis prompt asks the model to answer under
+HEADING_PATTERN = re.compile(r"^--- ANALYSIS OF .+ ---$", re.MULTILINE)
+BATCH_INSTRUCTION = "start its section with its heading line"
+
+WORDS = (
+    "standards students historical analysis curriculum immigration community "
+    "primary sources civic identity grade framework evidence inquiry culture"
+).split()
+
+
+def _words(seed: str, count: int) -> str:
+    """Deterministic filler text derived from seed"""
+    digest = hashlib.sha256(seed.encode("utf-8")).digest()
+    return " ".join(WORDS[(digest[i % len(digest)] + i) % len(WORDS)] for i in range(count))
+
+
+def _prompt_text(messages: List[Dict[str, Any]]) -> str:
+    return "".join(block.get("text", "") for message in messages for block in message["content"])
+
+
+def _cached_prefix(messages: List[Dict[str, Any]]) -> str:
+    """Prompt text before the last cache checkpoint, or "" when there is none"""
+    prefix, cached = "", ""
+    for message in messages:
+        for block in message["content"]:
+            if "cachePoint" in block:
+                cached = prefix
+            prefix += block.get("text", "")
+    return cached
+
+
+class StubClientError(Exception):
+    """Carries an error code the way botocore's ClientError does"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class StubBedrockClient:
+    """Fake bedrock-runtime client"""
+
+    def __init__(self, latency: float = 0.0, output_words: int = 200, stream_chunks: int = 20,
+                 supports_prompt_caching: bool = True, output_token_latency: float = 0.0):
+        self.latency = latency
+        # Seconds added per generated token, on top of latency
+        self.output_token_latency = output_token_latency
+        self.output_words = output_words
+        self.stream_chunks = stream_chunks
+        self.supports_prompt_caching = supports_prompt_caching
+        self.calls = 0
+        self._cached_prefixes = set()
+        self._lock = threading.Lock()
+
+    def _respond(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        prompt = _prompt_text(messages)
+        prefix = _cached_prefix(messages)
+        if prefix and not self.supports_prompt_caching:
+            raise StubClientError("ValidationException", "This model doesn't support the cachePoint field.")
+        with self._lock:
+            self.calls += 1
+            cache_hit = prefix in self._cached_prefixes
+            self._cached_prefixes.add(prefix)
+
+        # Like Bedrock, inputTokens only counts tokens that were not read from or written to the cache
+        prefix_tokens = len(prefix) // 4
+        input_tokens = len(prompt) // 4 - prefix_tokens
+        # Batched prompts get one section of output_words under each requested heading
+        headings = list(dict.fromkeys(HEADING_PATTERN.findall(prompt))) if BATCH_INSTRUCTION in prompt else []
+        if headings:
+            text = "\n".join(f"{heading}\n{_words(prompt + heading, self.output_words)}" for heading in headings)
+        else:
+            text = _words(prompt, self.output_words)
+        output_tokens = self.output_words * max(1, len(headings))
+        usage = {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": len(prompt) // 4 + output_tokens}
+        if prefix:
+            usage["cacheReadInputTokens" if cache_hit else "cacheWriteInputTokens"] = prefix_tokens
+        seconds = self.latency + output_tokens * self.output_token_latency
+        return {
+            "text": text,
+            "usage": usage,
+            "seconds": seconds,
+            "metrics": {"latencyMs": int(seconds * 1000)}
+        }
+
+    def converse(self, modelId: str, messages: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+        response = self._respond(messages)
+        time.sleep(response["seconds"])
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": response["text"]}]}},
+            "stopReason": "end_turn",
+            "usage": response["usage"],
+            "metrics": response["metrics"]
+        }
+
+    def converse_stream(self, modelId: str, messages: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+        response = self._respond(messages)
+        return {"stream": self._events(response)}
+
+    def _events(self, response: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        words = response["text"].split(" ")
+        chunk_size = max(1, len(words) // self.stream_chunks)
+        yield {"messageStart": {"role": "assistant"}}
+        for start in range(0, len(words), chunk_size):
+            time.sleep(response["seconds"] / self.stream_chunks)
+            text = " ".join(words[start:start + chunk_size])
+            yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": text if start == 0 else " " + text}}}
+        yield {"contentBlockStop": {"contentBlockIndex": 0}}
+        yield {"messageStop": {"stopReason": "end_turn"}}
+        yield {"metadata": {"usage": response["usage"], "metrics": response["metrics"]}}
+
+
+class StubRagClient:
+    """Fake bedrock-agent-runtime client"""
+
+    def __init__(self, latency: float = 0.0, results: int = 5, content_words: int = 120):
+        self.latency = latency
+        self.results = results
+        self.content_words = content_words
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def retrieve(self, knowledgeBaseId: str, retrievalQuery: Dict[str, str], **kwargs) -> Dict[str, Any]:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        query = retrievalQuery["text"]
+        configuration = kwargs.get("retrievalConfiguration", {}).get("vectorSearchConfiguration", {})
+        count = min(self.results, configuration.get("numberOfResults", self.results))
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": _words(f"{query}:{i}", self.content_words)},
+                    "location": {"type": "S3", "s3Location": {"uri": f"s3://stub-kb/source-{i + 1}.pdf"}},
+                    "metadata": {
+                        "x-amz-bedrock-kb-source-uri": f"https://example.org/stub-kb/source-{i + 1}.pdf",
+                        "title": f"Stub Source {i + 1}"
+                    },
+                    "score": round(1.0 - i * 0.1, 2)
+                }
+                for i in range(count)
+            ]
+        }
@@ -0,0 +1,169 @@
+"""Timed spans for pipeline runs.
+
+A Trace collects the spans of one run (document ingestion or a chat turn).
+Spans carry attributes such as token usage, Bedrock latency and cache hits.
+Traces can be appended to a local JSON lines file in the OTLP/JSON layout
+written by the OpenTelemetry collector's file exporter, so the output can be
+loaded by any OTLP-aware tool.
+"""
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+SERVICE_NAME = "alignment-helper"
+
+# Attribute names follow the OpenTelemetry GenAI conventions where one exists
+INPUT_TOKENS = "gen_ai.usage.input_tokens"
+OUTPUT_TOKENS = "gen_ai.usage.output_tokens"
+CACHE_READ_TOKENS = "gen_ai.usage.cache_read_input_tokens"
+CACHE_WRITE_TOKENS = "gen_ai.usage.cache_write_input_tokens"
+BEDROCK_LATENCY_MS = "bedrock.latency_ms"
+CACHE_OUTCOME = "cache.outcome"
+
+
+@dataclass
+class Span:
+    """One timed operation"""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_ns: int = 0
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """Seconds between start and end"""
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_usage(self, response: Dict[str, Any]) -> None:
+        """Token usage and latency from a converse response or stream metadata event"""
+        usage = response.get("usage", {})
+        if "inputTokens" in usage:
+            self.attributes[INPUT_TOKENS] = usage["inputTokens"]
+        if "outputTokens" in usage:
+            self.attributes[OUTPUT_TOKENS] = usage["outputTokens"]
+        # Prompt caching: tokens read from and written to the cache, on top of inputTokens
+        if usage.get("cacheReadInputTokens"):
+            self.attributes[CACHE_READ_TOKENS] = usage["cacheReadInputTokens"]
+        if usage.get("cacheWriteInputTokens"):
+            self.attributes[CACHE_WRITE_TOKENS] = usage["cacheWriteInputTokens"]
+        latency = response.get("metrics", {}).get("latencyMs")
+        if latency is not None:
+            self.attributes[BEDROCK_LATENCY_MS] = latency
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """Spans of one run; spans may be opened from several threads"""
+
+    def __init__(self, name: str, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self.root = self._start(name, None, attributes)
+
+    def _start(self, name: str, parent: Optional[Span], attributes: Dict[str, Any]) -> Span:
+        span = Span(name=name, trace_id=self.trace_id, span_id=secrets.token_hex(8),
+                    parent_id=parent.span_id if parent else None, start_ns=time.time_ns(), attributes=dict(attributes))
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+        """Time the body as a child of parent (the root span by default)"""
+        span = self._start(name, parent or self.root, attributes)
+        started = time.perf_counter_ns()
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e)
+            raise
+        finally:
+            span.end_ns = span.start_ns + time.perf_counter_ns() - started
+
+    def end(self) -> None:
+        self.root.end_ns = time.time_ns()
+
+    def usage(self) -> Dict[str, int]:
+        """Token totals and model call count across all spans"""
+        totals = {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0, "model_calls": 0}
+        for span in self.spans:
+            if INPUT_TOKENS in span.attributes:
+                totals["model_calls"] += 1
+                totals["input_tokens"] += span.attributes[INPUT_TOKENS]
+                totals["output_tokens"] += span.attributes.get(OUTPUT_TOKENS, 0)
+                totals["cache_read_tokens"] += span.attributes.get(CACHE_READ_TOKENS, 0)
+                totals["cache_write_tokens"] += span.attributes.get(CACHE_WRITE_TOKENS, 0)
+        return totals
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Child spans in start order, as plain dicts for display and JSON"""
+        return [
+            {"name": span.name, "duration_ms": round(span.duration * 1000, 1), "attributes": dict(span.attributes), "error": span.error}
+            for span in sorted(self.spans[1:], key=lambda span: span.start_ns)
+        ]
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [span.to_otlp() for span in self.spans]}]
+            }]
+        }
+
+
+class TraceExporter:
+    """Appends each finished trace as one OTLP/JSON line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["TraceExporter"]:
+        """Exporter for TRACE_EXPORT_PATH, or None when it is unset"""
+        path = os.getenv("TRACE_EXPORT_PATH")
+        return cls(path) if path else None
+
+    def export(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_otlp()) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)